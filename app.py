@@ -1,19 +1,22 @@
+import json
 import logging
 import os
-import threading
+import time
 
 import requests
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, jsonify, send_file, send_from_directory
+from flask import Flask, Response, render_template, request, jsonify, send_file, send_from_directory, stream_with_context
 from tempfile import NamedTemporaryFile
 
 from ebook_conversion.convert_file import convert_file
 from file_handling import is_encoding, random_str, make_folder
-from finetune.shared_resources import training_status
-from finetune.training_management import train
+from finetune.job_queue import job_queue, JobNotFound, QueueFull
+from finetune.shared_resources import render_event, training_status
 from forms import ContactForm, FineTuneForm, EbookConversionForm
 from set_folders import FileStorageHandler
 from logging_config import start_loggers
+from metrics import STAGE_SECONDS, render_metrics
+from profiling import profiled, profiling_requested
 from send_email import send_mail
 
 
@@ -24,6 +27,11 @@ start_loggers()
 error_logger = logging.getLogger("error_logger")
 
 MAX_FILE_SIZE = 2 * 1024 * 1024    # 2 MB
+STREAM_KEEPALIVE_SECONDS = 15
+STREAM_UNKNOWN_JOB_SECONDS = 60
+# Streams are closed after this long and the browser reconnects with Last-Event-ID
+STREAM_MAX_SECONDS = int(os.environ.get("STREAM_MAX_SECONDS", 300))
+STREAM_RETRY_MILLISECONDS = 1000
 UPLOAD_FOLDER = folders.upload_folder
 DOWNLOAD_FOLDER = folders.download_folder
 
@@ -34,6 +42,14 @@ app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 app.config["DOWNLOAD_FOLDER"] = DOWNLOAD_FOLDER
 app.config["MAX_CONTENT_LENGTH"] = MAX_FILE_SIZE
 
+# Resume any fine-tuning jobs left in the queue by a restart
+job_queue.start()
+
+
+def get_profile_token():
+    "The admin token asking for a job to be profiled, from a header or the form."
+    return request.headers.get("X-Profile-Token") or request.form.get("profile_token")
+
 
 @app.route("/")
 def landing_page():
@@ -99,13 +115,20 @@ def convert_ebook():
 
             folder_name, _ = make_folder()
             file_path = os.path.join(folder_name, uploaded_file.filename)
-            uploaded_file.save(file_path)
-            if uploaded_file.mimetype == "text/plain" and not is_encoding(file_path, "utf-8"):
-                error_logger.error(f"{file_path} is not UTF-8")
-                return jsonify({"error": "Not correct kind of text file. Please resave as UTF-8"}), 400
+            with STAGE_SECONDS.time(stage="upload_save"):
+                uploaded_file.save(file_path)
+            if uploaded_file.mimetype == "text/plain":
+                with STAGE_SECONDS.time(stage="utf8_validation"):
+                    valid = is_encoding(file_path, "utf-8")
+                if not valid:
+                    error_logger.error(f"{file_path} is not UTF-8")
+                    return jsonify({"error": "Not correct kind of text file. Please resave as UTF-8"}), 400
 
             metadata = {"title": title, "author": author}
-            book_name, psuedopath = convert_file(file_path, metadata)
+            profile = profiling_requested(get_profile_token())
+            with profiled(folder_name, "convert_file", profile):
+                # Profiled PDFs are read in this thread, so the profile covers the layout analysis
+                book_name, psuedopath = convert_file(file_path, metadata, in_thread=profile)
 
             with NamedTemporaryFile() as temp_file:
                 blob = DOWNLOAD_FOLDER.blob(psuedopath)
@@ -121,6 +144,7 @@ def finetune():
     if form.validate_on_submit():
         role = form.role.data
         chunk_type = form.chunk_type.data
+        beats_concurrency = form.beats_concurrency.data
         user_key = form.user_key.data
 
         # Validate user key
@@ -141,7 +165,8 @@ def finetune():
             ):
                 random_filename = f"{random_str()}.txt"
                 file_path = os.path.join(folder_name, random_filename)
-                file.save(file_path)
+                with STAGE_SECONDS.time(stage="upload_save"):
+                    file.save(file_path)
 
                 file_size = os.path.getsize(file_path)
                 min_size = 1024 # 1 KB
@@ -151,20 +176,95 @@ def finetune():
                     error_logger.error(f"{file_path} has an invalid size")
                     return jsonify({"error": "Invalid file size"}), 400
 
-                if not is_encoding(file_path, "utf-8"):
+                with STAGE_SECONDS.time(stage="utf8_validation"):
+                    valid = is_encoding(file_path, "utf-8")
+                if not valid:
                     os.remove(file_path)
                     error_logger.error(f"{file_path} is not UTF-8")
                     return jsonify({"error": "Not correct kind of text file. Please resave as UTF-8"}), 400
             else:
                 error_logger.error("File is not text file")
 
-        threading.Thread(target=train, args=(folder_name, role, user_key, chunk_type, user_folder)).start()
-        return jsonify({"success": True, "user_folder": user_folder}) 
+        try:
+            profile = profiling_requested(get_profile_token())
+            position = job_queue.submit(folder_name, role, user_key, chunk_type, user_folder, profile, beats_concurrency)
+        except QueueFull:
+            error_logger.error("Fine-tuning queue is full")
+            return jsonify({"error": "We are busy right now. Please try again in a few minutes"}), 503
+        return jsonify({"success": True, "user_folder": user_folder, "queue_position": position})
 
     return render_template("finetune.html", form=form)
 
+@app.route("/finetune/retry", methods=["POST"])
+def retry_finetune():
+    """
+    Puts a failed fine-tuning job back in the queue, resuming from its last
+    completed stage. Takes the job's user folder and the user's API key.
+    """
+    data = request.get_json()
+    user_folder = data.get("user_folder")
+    user_key = data.get("user_key") or ""
+    if not (user_key.startswith("sk-") and 50 < len(user_key) < 60):
+        error_logger.error("invalid key")
+        return jsonify({"error": "Invalid user key"}), 400
+    try:
+        position = job_queue.requeue(user_folder, user_key)
+    except JobNotFound:
+        return jsonify({"error": "No failed job to retry"}), 404
+    except QueueFull:
+        error_logger.error("Fine-tuning queue is full")
+        return jsonify({"error": "We are busy right now. Please try again in a few minutes"}), 503
+    return jsonify({"success": True, "user_folder": user_folder, "queue_position": position})
+
+@app.route("/metrics")
+def metrics():
+    "Exposes this worker's metrics in the Prometheus text format."
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/status", methods=["POST"])
 def status():
     data = request.get_json()
     user_folder = data.get("user_folder")
-    return jsonify({"status": training_status.get(user_folder, "Not started")})
+    return jsonify({"status": training_status.render(user_folder) or "Not started"})
+
+@app.route("/status/stream")
+def status_stream():
+    """
+    Streams a job's status events as Server-Sent Events. Only events after the
+    client's cursor are sent, taken from the Last-Event-ID header on reconnect or
+    the cursor query parameter. The stream ends once the job is finished, or
+    after STREAM_MAX_SECONDS so a long job does not hold a server thread, in
+    which case the browser's EventSource reconnects from the last event id.
+    """
+    user_folder = request.args.get("user_folder")
+    cursor = request.headers.get("Last-Event-ID") or request.args.get("cursor", "0")
+    try:
+        cursor = int(cursor)
+    except ValueError:
+        cursor = 0
+
+    def stream():
+        after = cursor
+        started = time.monotonic()
+        while True:
+            events = training_status.wait_for_events(user_folder, after, STREAM_KEEPALIVE_SECONDS)
+            if events is None and time.monotonic() - started > STREAM_UNKNOWN_JOB_SECONDS:
+                yield "event: end\ndata: Not started\n\n"
+                return
+            for event in events or []:
+                data = {"kind": event["kind"], "message": event["message"], "html": render_event(event)}
+                yield f"id: {event['seq']}\ndata: {json.dumps(data)}\n\n"
+                after = event["seq"]
+            if events is not None and training_status.is_finished(user_folder):
+                remaining = training_status.events(user_folder, after)
+                if not remaining:
+                    yield "event: end\ndata: finished\n\n"
+                    return
+            elif not events:
+                yield ": keep-alive\n\n"
+            if time.monotonic() - started > STREAM_MAX_SECONDS:
+                yield f"retry: {STREAM_RETRY_MILLISECONDS}\n\n"
+                return
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(stream()), mimetype="text/event-stream", headers=headers)
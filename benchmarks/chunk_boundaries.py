@@ -0,0 +1,101 @@
+"""
+Times how chunk boundaries are found in a 1 MB book: a plain backwards scan
+token by token against adjust_to_newline, which scans a bounded number of
+tokens and searches the rest of a chunk without a break at C speed.
+
+Run from the repository root:
+
+    python -m benchmarks.chunk_boundaries
+    python -m benchmarks.chunk_boundaries --book path/to/book.txt
+
+Without --book, a synthetic book of random token ids is used, with a paragraph
+break every --break-every tokens (0 for none), so every case of the original
+comparison can be reproduced. With --book, the book is encoded with the
+fine-tuning tokenizer.
+"""
+import argparse
+import random
+import time
+from array import array
+from typing import Callable, List
+
+from finetune.data_preparation import END_PARAGRAPH_TOKENS, TokenBuffer, adjust_to_newline, count_tokens
+
+CHUNK_SIZE = 4096
+# Roughly the number of cl100k_base tokens in 1 MB of English prose
+BOOK_TOKENS = 260_000
+NEWLINE_TOKEN = 198
+
+
+def scan_to_newline(tokens: TokenBuffer, end_index: int, start_index: int) -> int:
+    """
+    The backwards scan adjust_to_newline used to do, token by token, stopping at
+    start_index so that a chunk without a paragraph break ends.
+    """
+    index = end_index
+    while index > start_index and tokens[index - 1] not in END_PARAGRAPH_TOKENS:
+        index -= 1
+    return index if index > start_index else end_index
+
+def synthetic_tokens(count: int, break_every: int, seed: int = 3) -> TokenBuffer:
+    "Random non-paragraph token ids, with a newline about every break_every tokens."
+    rnd = random.Random(seed)
+    tokens = array("I", (rnd.randrange(20000, 90000) for _ in range(count)))
+    if break_every:
+        position = rnd.randint(1, break_every)
+        while position < count:
+            tokens[position] = NEWLINE_TOKEN
+            position += rnd.randint(break_every // 2, break_every * 3 // 2) or 1
+    return tokens
+
+def boundaries(tokens: TokenBuffer, find_end: Callable[[int, int], int]) -> List[int]:
+    "The end of every chunk of sliding_window_large, using find_end(end, start)."
+    ends = []
+    start_index = 0
+    while start_index < len(tokens):
+        end_index = min(start_index + CHUNK_SIZE, len(tokens))
+        if end_index < len(tokens):
+            end_index = find_end(end_index, start_index)
+        ends.append(end_index)
+        start_index = end_index
+    return ends
+
+def average_ms(runs: int, func: Callable[[], object]) -> float:
+    "The average duration of func over runs, in milliseconds."
+    started = time.perf_counter()
+    for _ in range(runs):
+        func()
+    return (time.perf_counter() - started) / runs * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--book", help="A UTF-8 text file to tokenize instead of the synthetic book")
+    parser.add_argument("--break-every", type=int, action="append",
+                        help="Tokens between paragraph breaks in the synthetic book; repeat for several cases")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.book:
+        with open(args.book, "r", encoding="utf-8") as f:
+            tokens, _ = count_tokens(f.read())
+        cases = [(args.book, tokens)]
+    else:
+        cases = [
+            (f"break every ~{break_every} tokens" if break_every else "no paragraph breaks",
+             synthetic_tokens(BOOK_TOKENS, break_every))
+            for break_every in (args.break_every or [0, 3000, 80])
+        ]
+
+    for name, tokens in cases:
+        scanned = boundaries(tokens, lambda end, start: scan_to_newline(tokens, end, start))
+        adjusted = boundaries(tokens, lambda end, start: adjust_to_newline(tokens, end, start))
+        assert scanned == adjusted, "adjust_to_newline and the scan disagree on the chunk boundaries"
+
+        scan_ms = average_ms(args.runs, lambda: boundaries(tokens, lambda end, start: scan_to_newline(tokens, end, start)))
+        adjust_ms = average_ms(args.runs, lambda: boundaries(tokens, lambda end, start: adjust_to_newline(tokens, end, start)))
+        print(f"{name}: {len(tokens)} tokens, {len(adjusted)} chunks")
+        print(f"  linear scan {scan_ms:.1f} ms -> adjust_to_newline {adjust_ms:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,13 @@
 import logging
 import os
+import time
 
 from ebook_conversion.docx_conversion import read_docx
 from ebook_conversion.epub_conversion import read_epub
 from ebook_conversion.pdf_conversion import read_pdf
 from ebook_conversion.text_conversion import parse_text_file
 from file_handling import read_text_file
+from metrics import CONVERSION_SECONDS, STAGE_SECONDS
 from set_folders import FileStorageHandler
 
 folders = FileStorageHandler()
@@ -13,12 +15,14 @@ folders = FileStorageHandler()
 
 error_logger = logging.getLogger("error_logger")
 
-def convert_file(file_path: str, metadata: dict) -> None:
+def convert_file(file_path: str, metadata: dict, in_thread: bool = False) -> None:
     """
     Converts a book to a text file with 3 asterisks for chapter breaks
     Arguments:
         book_name: Name of the book.
         folder_name: Name of the folder containing the book.
+        in_thread: Convert PDFs in the caller's thread even if the PDF pool is
+            enabled.
     """
 
     book_content = ""
@@ -34,20 +38,33 @@ def convert_file(file_path: str, metadata: dict) -> None:
         base_name = filename_list[0]
     extension = filename_list[-1].lower()
 
+    book_name = f"{base_name}.txt"
+    pseudopath=f"{folder}/{book_name}"
+
+    started = time.perf_counter()
+    if extension == "pdf":
+        # PDF pages are written out as they are converted rather than joined
+        # into one string
+        text_path = os.path.join(folder, book_name)
+        with open(text_path, "w", encoding="utf-8") as output:
+            read_pdf(file_path, metadata, output, in_thread=in_thread)
+        CONVERSION_SECONDS.observe(time.perf_counter() - started, format=extension)
+        with STAGE_SECONDS.time(stage="gcs_upload"):
+            folders.upload_file_to_gcs(text_path, pseudopath)
+        return book_name, pseudopath
+
     if extension == "epub":
         book_content = read_epub(file_path, metadata)
     elif extension == "docx":
         book_content = read_docx(file_path, metadata)
-    elif extension == "pdf":
-        book_content = read_pdf(file_path, metadata)
     elif extension == "txt" or extension == "text":
         book_content = read_text_file(file_path)
         book_content = parse_text_file(book_content)
     else:
         error_logger.error("Invalid file type")
+    CONVERSION_SECONDS.observe(time.perf_counter() - started, format=extension)
 
-    book_name = f"{base_name}.txt"
-    pseudopath=f"{folder}/{book_name}"
-    folders.write_to_gcs(book_content, pseudopath)
+    with STAGE_SECONDS.time(stage="gcs_upload"):
+        folders.write_to_gcs(book_content, pseudopath)
     return book_name, pseudopath
 
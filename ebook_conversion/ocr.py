@@ -1,12 +1,48 @@
 import base64
+import hashlib
+import json
 import logging
 import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import List
 
 import openai
-from openai import OpenAI
+
+from finetune.openai_client import get_client
+from finetune.rate_limiter import estimate_tokens, rate_limiter
+from finetune.retry import log_attempt, retry_policy
+from finetune.shared_resources import thread_local_storage
+from finetune.usage import usage_tracker
+from metrics import OPENAI_REQUEST_SECONDS, OPENAI_REQUESTS
 
 error_logger = logging.getLogger("error_logger")
 
+# Image groups, such as the header images of one page, sent in one vision request
+OCR_BATCH_SIZE = int(os.environ.get("OCR_BATCH_SIZE", 8))
+# OpenAI calls an OcrScheduler makes at once
+OCR_CONCURRENCY = int(os.environ.get("OCR_CONCURRENCY", 4))
+OCR_ANSWER_TOKENS = 10
+# Quotes and commas around each answer in a batched response
+BATCH_ANSWER_OVERHEAD_TOKENS = 6
+VISION_MODEL = "gpt-4-vision-preview"
+OCR_PROMPT = (
+    "Please provide the text in these images as a single combined "
+    "statement with spaces as appropriate without any commentary. Use "
+    "your judgment on whether consecutive images are a single word or "
+    "multiple words. If there is no text in the image, or it is "
+    "unreadable, respond with 'No text found'"
+)
+BATCH_OCR_PROMPT = (
+    "Below are {count} numbered groups of images. For each group, provide the "
+    "text in its images as a single combined statement with spaces as "
+    "appropriate. Use your judgment on whether consecutive images are a single "
+    "word or multiple words. If there is no text in a group, or it is "
+    "unreadable, its answer is 'No text found'. Respond only with a JSON array "
+    "of {count} strings, one answer per group in order, without any commentary."
+)
+
 
 def encode_image(image_path):
     "Encode an image to base64"
@@ -14,30 +50,52 @@ def encode_image(image_path):
     with open(image_path, "rb") as image_file:
         return base64.b64encode(image_file.read()).decode('utf-8')
 
-def call_api(payload: dict) -> str:
-    "Call OpenAI's ChatCompletions API endopoint for OCR or double-checking response"
+def call_api(payload: dict, endpoint: str = "ocr") -> str:
+    """
+    Call OpenAI's ChatCompletions API endopoint for OCR or double-checking response,
+    retrying according to the shared retry policy. If the primary key stays rate
+    limited, the fallback key is tried. Calls are timed, counted and their usage
+    recorded under the given endpoint name.
+    """
+
+    attempts = 0
+    usage = None
+
+    def request_answer(api_key: str) -> str:
+        nonlocal attempts, usage
+        attempts += 1
+        client = get_client(api_key)
+        rate_limiter.acquire(api_key, estimate_tokens(payload["messages"], payload.get("max_tokens", 0)))
+        raw_response = client.chat.completions.with_raw_response.create(**payload)
+        rate_limiter.update_limits(api_key, raw_response.headers)
+        response = raw_response.parse()
+        usage = response.usage
+        if response.choices:
+            return response.choices[0].message.content or ""
+        raise Exception("No choices in response")
 
-    api_key = os.getenv("PROSEPAL_OCR_KEY")
-    client = OpenAI(api_key=api_key)
+    started = time.perf_counter()
     try:
-        response = client.chat.completions.create(payload)
-        if response.json()["choices"]:
-            answer = response.json()["choices"][0]["message"]["content"]
-            return answer
-        if response.json()["error"]:
-            error = response.json()["error"]["message"]
-            raise Exception(error)
-    except KeyError as e:
-        error_logger.exception(f"Error: {e}\nResponse: {response.text}")
-        return ""
-    except openai.APIStatusError as e:
-        if e.status_code==429:
-            client.close()
-            client = OpenAI(api_key=os.environ("PROSEPAL_OCR_KEY_FALLBACK"))
-            return call_api(payload)
+        try:
+            answer = retry_policy.call(request_answer, os.getenv("PROSEPAL_OCR_KEY"), on_error=log_attempt)
+        except openai.RateLimitError:
+            fallback_key = os.getenv("PROSEPAL_OCR_KEY_FALLBACK")
+            if not fallback_key:
+                raise
+            answer = retry_policy.call(request_answer, fallback_key, on_error=log_attempt)
+        OPENAI_REQUESTS.inc(endpoint=endpoint, outcome="success")
+        return answer
     except Exception as e:
+        OPENAI_REQUESTS.inc(endpoint=endpoint, outcome="error")
         error_logger.exception(f"Error: {e}")
         return ""
+    finally:
+        elapsed = time.perf_counter() - started
+        OPENAI_REQUEST_SECONDS.observe(elapsed, endpoint=endpoint)
+        usage_tracker.record(
+            endpoint, payload["model"], usage, elapsed, max(0, attempts - 1),
+            job_id=getattr(thread_local_storage, "user_folder", None)
+        )
 
 def double_check_answer(ocr_text: str) -> str:
     "Use GPT 3.5 to translate garbled OCR response"
@@ -54,8 +112,83 @@ def double_check_answer(ocr_text: str) -> str:
         ],
         "max_tokens": 10
     }
+    return call_api(payload, endpoint="ocr_double_check")
+
+def image_parts(base64_images: list) -> list:
+    "Message content parts for a list of base64 encoded images."
+
+    return [{
+        "type": "image_url",
+        "image_url": {
+            "url": f"data:image/jpeg;base64,{base64_image}",
+            "detail": "low"
+        }
+    } for base64_image in base64_images]
+
+def read_images(base64_images: list) -> str:
+    "Call GPT-4 Vision for the text in one group of images."
+
+    payload = {
+        "model": VISION_MODEL,
+        "messages": [{
+            "role": "user",
+            "content": [{"type": "text", "text": OCR_PROMPT}, *image_parts(base64_images)]
+        }],
+        "max_tokens": OCR_ANSWER_TOKENS
+    }
     return call_api(payload)
 
+def parse_batch_answer(answer: str, count: int) -> List[str]:
+    """
+    Reads the JSON array of answers to a batched vision request, allowing for a
+    Markdown code fence around it. Returns None unless it holds exactly count
+    strings.
+    """
+
+    answer = answer.strip()
+    if answer.startswith("```"):
+        answer = answer.strip("`").strip()
+        if answer.startswith("json"):
+            answer = answer[len("json"):]
+    try:
+        answers = json.loads(answer)
+    except ValueError:
+        return None
+    if not isinstance(answers, list) or len(answers) != count or not all(isinstance(a, str) for a in answers):
+        return None
+    return answers
+
+def read_image_batch(image_groups: List[list]) -> List[str]:
+    """
+    Call GPT-4 Vision once for the text in several groups of images, asking for
+    one answer per group. If the response cannot be matched to the groups, each
+    group is read with its own request instead.
+
+    Arguments:
+        image_groups (list): Lists of base64-encoded images, one list per group.
+
+    Returns: The text of each group, in order.
+    """
+
+    if len(image_groups) == 1:
+        return [read_images(image_groups[0])]
+
+    content = [{"type": "text", "text": BATCH_OCR_PROMPT.format(count=len(image_groups))}]
+    for number, base64_images in enumerate(image_groups, 1):
+        content.append({"type": "text", "text": f"Group {number}:"})
+        content.extend(image_parts(base64_images))
+    payload = {
+        "model": VISION_MODEL,
+        "messages": [{"role": "user", "content": content}],
+        "max_tokens": (OCR_ANSWER_TOKENS + BATCH_ANSWER_OVERHEAD_TOKENS) * len(image_groups)
+    }
+    answer = call_api(payload)
+    answers = parse_batch_answer(answer, len(image_groups)) if answer else None
+    if answers is None:
+        error_logger.error(f"Could not match batched OCR answer to {len(image_groups)} image groups: {answer!r}")
+        return [read_images(base64_images) for base64_images in image_groups]
+    return answers
+
 def run_ocr(base64_images: list) -> str:
     """
     Create payload for OpenAI API call to GPT-4 Vision for OCR, based on list of
@@ -68,36 +201,94 @@ def run_ocr(base64_images: list) -> str:
     Returns str: The recognized text from the images.
     """
 
-    image_role_list = []
-
-    for base64_image in base64_images:
-        image_role_list.append({
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:image/jpeg;base64,{base64_image}",
-                "detail": "low"
-            }
-        })
-    payload = {
-        "model": "gpt-4-vision-preview",
-        "messages": [{
-            "role": "user",
-            "content": [{
-                "type": "text",
-                "text": (
-                    "Please provide the text in these images as a single combined "
-                    "statement with spaces as appropriate without any commentary. Use "
-                    "your judgment on whether consecutive images are a single word or "
-                    "multiple words. If there is no text in the image, or it is "
-                    "unreadable, respond with 'No text found'"
-                )},
-                *image_role_list
-            ]
-        }],
-        "max_tokens": 10
-    }
-    ocr_text = call_api(payload)
+    ocr_text = read_images(base64_images)
     if ocr_text:
         return double_check_answer(ocr_text)
     else:
-        return ""
\ No newline at end of file
+        return ""
+
+
+class OcrScheduler:
+    """
+    Collects groups of images to OCR, such as the header images of each page of
+    a book, and reads them in batches of up to batch_size groups per vision
+    request. Each answer is then double checked separately. Vision requests and
+    double checks run in a thread pool of at most concurrency workers, so many
+    pages are in flight at once while the rate limiter keeps the total in check.
+
+    submit returns a future for the text of a group, which is run_ocr's answer
+    for the same images. Groups identical to one already submitted share its
+    future; only a hash of each group is kept, so images are released once
+    their batch has been read. Batches are sent as they fill up; flush sends a partly filled one.
+    Use the scheduler as a context manager so every request has finished when
+    it exits.
+    """
+
+    def __init__(self, batch_size: int = OCR_BATCH_SIZE, concurrency: int = OCR_CONCURRENCY):
+        self.batch_size = max(1, batch_size)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+        self._user_folder = getattr(thread_local_storage, "user_folder", None)
+        self._pending = []
+        self._submitted = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "OcrScheduler":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, base64_images: list) -> Future:
+        "Queue a group of images, returning a future for its text."
+
+        key = hashlib.sha256("\0".join(base64_images).encode("utf-8")).digest()
+        with self._lock:
+            future = self._submitted.get(key)
+            if future is not None:
+                return future
+            future = self._submitted[key] = Future()
+            self._pending.append((base64_images, future))
+            if len(self._pending) >= self.batch_size:
+                self._send_pending()
+        return future
+
+    def flush(self):
+        "Send the queued groups without waiting for the batch to fill up."
+
+        with self._lock:
+            self._send_pending()
+
+    def close(self):
+        "Send the queued groups and wait for every answer."
+
+        self.flush()
+        wait(list(self._submitted.values()))
+        self._executor.shutdown()
+
+    def _send_pending(self):
+        if self._pending:
+            self._executor.submit(self._read_batch, self._pending)
+            self._pending = []
+
+    def _read_batch(self, batch: list):
+        "Read a batch of groups in a worker thread and queue their double checks."
+
+        thread_local_storage.user_folder = self._user_folder
+        try:
+            answers = read_image_batch([base64_images for base64_images, _ in batch])
+        except Exception as e:
+            error_logger.exception(f"Error: {e}")
+            answers = [""] * len(batch)
+        for answer, (_, future) in zip(answers, batch):
+            if answer:
+                self._executor.submit(self._double_check, answer, future)
+            else:
+                future.set_result("")
+
+    def _double_check(self, ocr_text: str, future: Future):
+        thread_local_storage.user_folder = self._user_folder
+        try:
+            future.set_result(double_check_answer(ocr_text))
+        except Exception as e:
+            error_logger.exception(f"Error: {e}")
+            future.set_result("")
\ No newline at end of file
@@ -1,20 +1,29 @@
 import base64
 import logging
+import os
 import re
-from io import BytesIO
-from typing import Any, Tuple
-
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque
+from io import BytesIO, StringIO
+from itertools import islice
+from typing import Any, List, Optional, TextIO, Tuple
+
+from pdfminer.converter import PDFPageAggregator
+from pdfminer.pdfdevice import PDFTextDevice
+from pdfminer.pdffont import PDFUnicodeNotDefined
 from pdfminer.pdfparser import PDFParser
 from pdfminer.pdfdocument import PDFDocument
-from pdfminer.pdfinterp import resolve1
+from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager, resolve1
+from pdfminer.pdfpage import PDFPage
 from pdfminer.pdftypes import PDFStream
-from pdfminer.layout import LTChar, LTContainer, LTText
-from pdfminer.high_level import extract_pages
+from pdfminer.layout import IndexAssigner, LAParams, LTChar, LTContainer, LTLayoutContainer, LTPage, LTText, LTTextLineHorizontal
+from pdfminer.utils import apply_matrix_pt
 from PIL import Image
 
 from ebook_conversion.chapter_check import is_chapter, is_not_chapter, CHAPTER_MARKER
-from ebook_conversion.ocr import run_ocr
+from ebook_conversion.ocr import OcrScheduler
 from ebook_conversion.text_conversion import desmarten_text
+from process_pool import SpawnPool
 
 
 error_logger = logging.getLogger("error_logger")
@@ -22,6 +31,21 @@ info_logger = logging.getLogger("info_logger")
 
 END_PARAGRAPH = ('.', '!', '?', '."', '!"', '?"')
 
+# Number of processes converting the pages of long PDFs. Set to 0 to convert
+# every PDF in the caller's thread. Each gunicorn worker has its own pool, and
+# each process holds a parsed copy of the PDF in memory.
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", min(2, os.cpu_count() or 1)))
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get("PDF_PARALLEL_MIN_PAGES", 40))
+PDF_MIN_PAGES_PER_TASK = 10
+PDF_TASKS_PER_WORKER = 2
+# Pages held back waiting for OCR before the oldest one is waited for
+PDF_OCR_WINDOW_PAGES = int(os.environ.get("PDF_OCR_WINDOW_PAGES", 64))
+# Read pages with a text layer and no images without full layout analysis
+PDF_FAST_TEXT_LAYER = os.environ.get("PDF_FAST_TEXT_LAYER", "1") == "1"
+# Nested form XObjects searched for images before a page is read the slow way
+MAX_XOBJECT_DEPTH = 3
+pdf_pool = SpawnPool(PDF_WORKERS)
+
 def create_image_from_binary(binary_data, width: int, height: int) -> str:
     """
     Create an image from binary data.
@@ -81,34 +105,214 @@ def extract_image(document: bytes, obj_num: int, attempt: int) -> str:
         info_logger.info(f"Issue: {e} with object: {obj_num}")
         return extract_image(document, obj_num + 1, attempt + 1)
 
-def parse_img_obj(file_path: str, obj_nums: list) -> str:
+def parse_img_obj(document: PDFDocument, obj_nums: list, image_cache: Optional[dict] = None) -> List[str]:
     """
-    Extracts and processes images from a PDF file, then performs OCR to convert
-    images to text.
+    Extracts the images of a page from a PDF file, ready to be OCRed.
 
-    This function takes the path of a PDF file and a list of object numbers
+    This function takes the parsed PDF document and a list of object numbers
     (obj_nums) which are potential image objects within the PDF. It attempts 
-    to extract images from these objects and then uses OCR to convert these 
-    images into text. The text from all images is concatenated and returned 
-    as a single string.
+    to extract images from these objects as base64-encoded JPEGs. OCR is left
+    to the caller, so the images of many pages can be read together.
 
     Arguments:
-        file_path (str): The file path to the PDF from which to extract images.
+        document (PDFDocument): The parsed PDF from which to extract images.
         obj_nums (list): A list of object numbers in the PDF that potentially
         contain images.
+        image_cache (dict): Images already extracted from the document, by
+        object number, shared by every page so each object is decoded once.
+
+    Returns base64_images (list): the images that could be extracted.
+    """
+
+    if image_cache is None:
+        image_cache = {}
+    base64_images = []
+    for obj_num in obj_nums:
+        if obj_num not in image_cache:
+            image_cache[obj_num] = extract_image(document, obj_num, attempt = 0)
+        image = image_cache[obj_num]
+        base64_images.append(image) if image else None
+    return base64_images
+
+def has_images(resources: Any, depth: int = 0) -> bool:
+    """
+    Checks whether a page's resources include image XObjects, looking inside
+    form XObjects up to MAX_XOBJECT_DEPTH deep. Anything that cannot be checked
+    counts as an image.
+    """
 
-    Returns text (str): the concatenated text extracted from all images.
+    xobjects = resolve1(resources.get("XObject")) if isinstance(resources, dict) else None
+    if not isinstance(xobjects, dict):
+        return False
+    for xobject in xobjects.values():
+        xobject = resolve1(xobject)
+        if not isinstance(xobject, PDFStream):
+            return True
+        subtype = getattr(xobject.get("Subtype"), "name", None)
+        if subtype == "Image":
+            return True
+        if subtype == "Form":
+            if depth >= MAX_XOBJECT_DEPTH or has_images(resolve1(xobject.get("Resources")), depth + 1):
+                return True
+    return False
+
+def has_text_layer(page: PDFPage) -> bool:
+    "Checks whether a page has fonts to extract text from and no images to OCR."
+
+    resources = resolve1(page.resources)
+    if not isinstance(resources, dict) or not resolve1(resources.get("Font")):
+        return False
+    return not has_images(resources)
+
+
+class TextLayerLine(LTTextLineHorizontal):
+    """
+    A line of text found by TextLayerDevice. It stands in for pdfminer's line of
+    LTChar objects, holding only the line's text and bounding box.
     """
 
-    with open(file_path, 'rb') as f:
-        parser = PDFParser(f)
-        document = PDFDocument(parser)
-        base64_images = []
-        for obj_num in obj_nums:
-            image = extract_image(document, obj_num, attempt = 0)
-            base64_images.append(image) if image else None
-    text = run_ocr(base64_images) if base64_images else ""
-    return text
+    def __init__(self, text: str, bbox: Tuple[float, float, float, float], word_margin: float):
+        super().__init__(word_margin)
+        self.text = text
+        self.set_bbox(bbox)
+
+    def get_text(self) -> str:
+        return self.text + "\n"
+
+
+class TextLayerDevice(PDFTextDevice):
+    """
+    A lightweight pdfminer device for pages with a text layer and no images.
+
+    Characters are kept as (text, x0, y0, x1, y1) tuples rather than LTChar
+    objects and grouped into lines the way layout analysis groups them. Only
+    the lines become layout objects, which pdfminer's own analysis then groups
+    into text boxes and orders by position, so the page reads as it does with
+    full layout analysis. As with the layout path, text inside form XObjects is
+    left out. Pages with vertical text are marked unsupported so they can be
+    laid out in full instead.
+    """
+
+    def __init__(self, rsrcmgr: PDFResourceManager, laparams: Optional[LAParams] = None):
+        super().__init__(rsrcmgr)
+        self.laparams = laparams or LAParams()
+        self.chars = []
+        self.bbox = (0, 0, 0, 0)
+        self.figure_depth = 0
+        self.unsupported = False
+
+    def begin_page(self, page: PDFPage, ctm: Any):
+        "Starts a page, with the same bounding box layout analysis gives it."
+
+        (x0, y0, x1, y1) = page.mediabox
+        (x0, y0) = apply_matrix_pt(ctm, (x0, y0))
+        (x1, y1) = apply_matrix_pt(ctm, (x1, y1))
+        self.bbox = (0, 0, abs(x0 - x1), abs(y0 - y1))
+        self.chars = []
+        self.figure_depth = 0
+        self.unsupported = False
+
+    def begin_figure(self, name: str, bbox: Any, matrix: Any):
+        self.figure_depth += 1
+
+    def end_figure(self, name: str):
+        self.figure_depth -= 1
+
+    def render_char(self, matrix, font, fontsize, scaling, rise, cid, ncs, graphicstate) -> float:
+        "Records a character's text and bounding box, as LTChar computes them."
+
+        adv = font.char_width(cid) * fontsize * scaling
+        if font.is_vertical():
+            self.unsupported = True
+            return adv
+        if self.figure_depth:
+            return adv
+        try:
+            text = font.to_unichr(cid)
+        except PDFUnicodeNotDefined:
+            text = f"(cid:{cid})"
+        descent = font.get_descent() * fontsize
+        (x0, y0) = apply_matrix_pt(matrix, (0, descent + rise))
+        (x1, y1) = apply_matrix_pt(matrix, (adv, descent + rise + fontsize))
+        if x1 < x0:
+            (x0, x1) = (x1, x0)
+        if y1 < y0:
+            (y0, y1) = (y1, y0)
+        self.chars.append((text, x0, y0, x1, y1))
+        return adv
+
+    def make_line(self, chars: list) -> TextLayerLine:
+        "Joins characters into a line, with a space where a gap exceeds word_margin."
+
+        parts = []
+        previous_x1 = None
+        for text, x0, y0, x1, y1 in chars:
+            margin = self.laparams.word_margin * max(x1 - x0, y1 - y0)
+            if previous_x1 is not None and previous_x1 < x0 - margin:
+                parts.append(" ")
+            parts.append(text)
+            previous_x1 = x1
+        bbox = (
+            min(char[1] for char in chars), min(char[2] for char in chars),
+            max(char[3] for char in chars), max(char[4] for char in chars)
+        )
+        return TextLayerLine("".join(parts), bbox, self.laparams.word_margin)
+
+    def group_lines(self) -> List[TextLayerLine]:
+        """
+        Groups the page's characters into lines as pdfminer's group_objects does:
+        each character joins the line of the one before it if they overlap
+        vertically by more than line_overlap and sit within char_margin of each
+        other, and a character that joins neither neighbour is a line of its own.
+        """
+
+        laparams = self.laparams
+        lines = []
+        line = None
+        previous = None
+        for char in self.chars:
+            if previous is not None:
+                _, px0, py0, px1, py1 = previous
+                _, x0, y0, x1, y1 = char
+                voverlap = min(abs(py0 - y1), abs(py1 - y0)) if y0 <= py1 and py0 <= y1 else 0
+                hdistance = 0 if x0 <= px1 and px0 <= x1 else min(abs(px0 - x1), abs(px1 - x0))
+                halign = (
+                    y0 <= py1 and py0 <= y1
+                    and min(py1 - py0, y1 - y0) * laparams.line_overlap < voverlap
+                    and hdistance < max(px1 - px0, x1 - x0) * laparams.char_margin
+                )
+                if halign and line is not None:
+                    line.append(char)
+                elif line is not None:
+                    lines.append(self.make_line(line))
+                    line = None
+                elif halign:
+                    line = [previous, char]
+                else:
+                    lines.append(self.make_line([previous]))
+            previous = char
+        if previous is not None:
+            lines.append(self.make_line(line if line is not None else [previous]))
+        return lines
+
+    def get_text(self) -> str:
+        """
+        Returns the page's text as process_page_elements collects it from a laid
+        out page: the text of each text box in reading order followed by a blank
+        line, then any whitespace-only lines.
+        """
+
+        lines = self.group_lines()
+        empties = [line for line in lines if line.is_empty()]
+        lines = [line for line in lines if not line.is_empty()]
+        container = LTLayoutContainer(self.bbox)
+        boxes = list(container.group_textlines(self.laparams, lines))
+        assigner = IndexAssigner()
+        for group in container.group_textboxes(self.laparams, boxes):
+            group.analyze(self.laparams)
+            assigner.run(group)
+        boxes.sort(key=lambda box: box.index)
+        return "".join(box.get_text() + "\n" for box in boxes) + "".join(line.get_text() + "\n" for line in empties)
 
 def process_element(element: Any) -> Tuple[str, Any]:
     """
@@ -144,8 +348,6 @@ def parse_pdf_page(page: str, metadata: dict) -> str:
         page: A pdf page.
     Returns the pdf page as a string.
     """
-    print("entering function")
-    
     def remove_extra_spaces(line: str) -> str:
         "Remove extra spaces in middle of string"
         return " ".join(line.split())
@@ -193,48 +395,171 @@ def parse_pdf_page(page: str, metadata: dict) -> str:
         page_list.append(concatenate_paragraph(paragraph_list))
     return "\n".join(page_list)
 
-def read_pdf(file_path: str, metadata: dict) -> str:
+class PageWriter:
+    """
+    Writes converted pages to a text stream in page order as they are finished,
+    so the book is never rebuilt as one growing string.
+
+    Each page is followed by a newline if it ends a paragraph, or a space if the
+    paragraph carries on to the next page. A chapter marker at the very start of
+    the book is stripped.
+    """
+
+    def __init__(self, output: TextIO):
+        self.output = output
+        self.started = False
+
+    def write_page(self, page_text: str):
+        "Append the processed page text to the output."
+
+        separator = "\n" if page_text.rstrip().endswith(END_PARAGRAPH) else " "
+        if not self.started:
+            self.started = True
+            if page_text.startswith(CHAPTER_MARKER):
+                page_text = page_text.lstrip(CHAPTER_MARKER)
+        self.output.write(page_text)
+        self.output.write(separator)
+
+def process_page_elements(page: LTPage, document: PDFDocument, image_cache: dict) -> Tuple[List[str], str]:
+    "Processes the elements of a PDF page into its images and its text."
+
+    text_parts = []
+    obj_nums = []
+    for element in page:
+        obj_type, content = process_element(element)
+        if obj_type == "image":
+            obj_nums.append(content)
+        elif obj_type == "text" and content != "No text found":
+            text_parts.append(content + "\n")
+    base64_images = parse_img_obj(document, obj_nums, image_cache)
+    return base64_images, "".join(text_parts)
+
+def extract_pages(file_path: str, start: int = 0, end: Optional[int] = None) -> List[Tuple[List[str], str]]:
+    """
+    Extracts the images and text of the pages of a PDF from start up to end.
+    Runs either in the caller's thread or in a process of the PDF pool, leaving
+    OCR to the caller.
+
+    The file is parsed once and shared between layout analysis and image
+    extraction. Unless PDF_FAST_TEXT_LAYER is off, pages with a text layer and
+    no images are read with TextLayerDevice, skipping character layout; every
+    other page is laid out in full and its images are extracted.
+
+    Arguments:
+        file_path (str): The path to the PDF file.
+        start (int): The index of the first page to extract.
+        end (int): The index after the last page to extract, or None for the
+        rest of the document.
+
+    Returns: The base64-encoded images and the text of each page, in page order.
+    """
+
+    pages = []
+    with open(file_path, "rb") as f:
+        document = PDFDocument(PDFParser(f))
+        image_cache = {}
+        resource_manager = PDFResourceManager(caching=True)
+        layout_device = PDFPageAggregator(resource_manager, laparams=LAParams())
+        layout_interpreter = PDFPageInterpreter(resource_manager, layout_device)
+        text_device = TextLayerDevice(resource_manager)
+        text_interpreter = PDFPageInterpreter(resource_manager, text_device)
+
+        for page in islice(PDFPage.create_pages(document), start, end):
+            pdf_text = None
+            if PDF_FAST_TEXT_LAYER and has_text_layer(page):
+                text_interpreter.process_page(page)
+                if not text_device.unsupported:
+                    base64_images, pdf_text = [], text_device.get_text()
+            if pdf_text is None:
+                layout_interpreter.process_page(page)
+                base64_images, pdf_text = process_page_elements(layout_device.get_result(), document, image_cache)
+            pages.append((base64_images, pdf_text))
+    return pages
+
+def count_pages(file_path: str) -> int:
+    "Returns the number of pages in a PDF file."
+
+    with open(file_path, "rb") as f:
+        document = PDFDocument(PDFParser(f))
+        pages = resolve1(document.catalog.get("Pages"))
+        count = resolve1(pages.get("Count")) if isinstance(pages, dict) else None
+        if isinstance(count, int):
+            return count
+        return sum(1 for _ in PDFPage.create_pages(document))
+
+def page_ranges(total_pages: int, workers: int) -> List[Tuple[int, int]]:
     """
-    Reads the contents of a PDF file and returns it as a string.
+    Splits the pages into contiguous ranges, a few per worker so that a slow
+    range does not hold up the others, but no smaller than PDF_MIN_PAGES_PER_TASK.
+    """
+
+    tasks = max(1, min(workers * PDF_TASKS_PER_WORKER, total_pages // PDF_MIN_PAGES_PER_TASK))
+    size = -(-total_pages // tasks)
+    return [(start, min(start + size, total_pages)) for start in range(0, total_pages, size)]
+
+def read_pdf(file_path: str, metadata: dict, output: Optional[TextIO] = None, in_thread: bool = False) -> str:
+    """
+    Reads the contents of a PDF file and returns it as a string, or writes it
+    page by page to output if one is given.
+
+    Long PDFs are split into page ranges extracted in parallel in the PDF pool,
+    each parsing the file once and sharing it between layout analysis and image
+    extraction, and the pages are joined back in page order. Short PDFs, or
+    every PDF if PDF_WORKERS is 0 or in_thread is set, are extracted in the
+    caller's thread. The images of every page go to one OcrScheduler as they
+    arrive, so header images are read in batches and concurrently while later
+    pages are still extracted. Pages are written in order as soon as their OCR is done, holding back at
+    most PDF_OCR_WINDOW_PAGES pages.
 
     Args:
         file_path: The path to the PDF file.
         metadata: A dictionary containing the title and author of the file.
+        output: A text stream, such as an open file or GCS blob, to write the
+            processed contents to as each page is finished.
+        in_thread: Extract every page in the caller's thread, as profiled
+            conversions do so the profile covers the extraction.
 
     Returns:
-        A string representing the processed contents of the PDF file.
+        A string representing the processed contents of the PDF file, or an
+        empty string if they were written to output.
     """
 
-    def append_page_text(page_text: str, full_text: str) -> str:
-        "Append the processed page text to the full text."
-
-        if page_text.rstrip().endswith(END_PARAGRAPH):
-            return full_text + page_text + "\n"
+    buffer = StringIO() if output is None else None
+    writer = PageWriter(output if output is not None else buffer)
+    waiting = deque()
+
+    def write_ready(limit: int):
+        "Write finished pages, waiting for the oldest while more than limit are held back."
+        while waiting:
+            ocr_future, pdf_text = waiting[0]
+            if ocr_future is not None and not ocr_future.done():
+                if len(waiting) <= limit:
+                    return
+                scheduler.flush()
+            ocr_text = ocr_future.result() if ocr_future is not None else ""
+            writer.write_page(parse_pdf_page(ocr_text + "\n\n" + pdf_text, metadata))
+            waiting.popleft()
+
+    total_pages = count_pages(file_path) if PDF_WORKERS > 0 and not in_thread else 0
+    pool = None
+    futures = []
+    try:
+        if total_pages >= PDF_PARALLEL_MIN_PAGES:
+            ranges = page_ranges(total_pages, PDF_WORKERS)
+            pool = pdf_pool.get()
+            futures = [pool.submit(extract_pages, file_path, start, end) for start, end in ranges]
+            pages = (page for future in futures for page in future.result())
         else:
-            return full_text + page_text + " "
-
-    def process_page_elements(page) -> Tuple[str, str]:
-        "Processes the elements of a PDF page."
-
-        pdf_text = ""
-        obj_nums = []
-        for element in page:
-            obj_type, content = process_element(element)
-            if obj_type == "image":
-                obj_nums.append(content)
-            elif obj_type == "text" and content != "No text found":
-                pdf_text += content + "\n"
-        ocr_text = parse_img_obj(file_path, obj_nums)
-        return ocr_text, pdf_text
-
-    full_text = ""
-    for page in extract_pages(file_path):
-        ocr_text, pdf_text = process_page_elements(page)
-        page_text = ocr_text + "\n\n" + pdf_text if ocr_text is not None else pdf_text
-        pdf_page = parse_pdf_page(page_text, metadata)
-        full_text = append_page_text(pdf_page, full_text)
-
-    if full_text.startswith(CHAPTER_MARKER):
-        return full_text.lstrip(CHAPTER_MARKER)
-    else:
-        return full_text
+            pages = extract_pages(file_path)
+        with OcrScheduler() as scheduler:
+            for base64_images, pdf_text in pages:
+                waiting.append((scheduler.submit(base64_images) if base64_images else None, pdf_text))
+                write_ready(PDF_OCR_WINDOW_PAGES)
+            write_ready(0)
+    except BrokenProcessPool:
+        pdf_pool.discard(pool)
+        raise
+    finally:
+        for future in futures:
+            future.cancel()
+    return buffer.getvalue() if buffer is not None else ""
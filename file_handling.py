@@ -2,6 +2,7 @@ import json
 import os
 import secrets
 import string
+from typing import Iterable
 
 from set_folders import FileStorageHandler
 
@@ -43,9 +44,16 @@ def read_text_file(file_path: str) -> str:
         read_file = f.read()
     return read_file
 
-def write_jsonl_file(content: list, file_path: str):
-    "Writes a list of dictionaries to a JSONL file"
-    with open(file_path, "a") as f:
+def write_jsonl_file(content: Iterable[dict], file_path: str, buffer_size: int = 1024 * 1024) -> int:
+    """
+    Writes an iterable of dictionaries to a JSONL file, serializing each item as it
+    arrives so the whole dataset never has to be held in memory. Any existing file
+    is overwritten. Returns the number of lines written.
+    """
+    lines = 0
+    with open(file_path, "w", buffering=buffer_size) as f:
         for item in content:
-            json.dump(item, f)
+            f.write(json.dumps(item))
             f.write("\n")
+            lines += 1
+    return lines
@@ -1,15 +1,25 @@
-import time
 import logging
-from typing import Any, Optional
+import time
+from typing import Any
 
 import openai
 
+from metrics import OPENAI_REQUEST_SECONDS, OPENAI_REQUESTS
+from send_email import email_admin
+from finetune.beat_cache import beat_cache
 from finetune.openai_client import get_client
+from finetune.rate_limiter import estimate_tokens, rate_limiter
+from finetune.retry import FATAL, log_attempt, retry_policy
 from finetune.shared_resources import training_status, thread_local_storage
+from finetune.usage import usage_tracker
 
 error_logger = logging.getLogger("error_logger")
 
 
+class ReportedError(Exception):
+    "Raised in place of an error error_handle has already reported to the user and administrator."
+
+
 def check_json_response(response: Any) -> dict:
     """Attempt to parse JSON safely. Return None if parsing fails."""
 
@@ -18,93 +28,105 @@ def check_json_response(response: Any) -> dict:
     except ValueError:
         return {} 
 
-def error_handle(e: Any, retry_count: int = 0) -> int:
+def error_handle(e: Any):
     """
-    Determines whether error is unresolvable or should be retried. If unresolvable,
-    error is logged and administrator is emailed before exit. Otherwise, exponential
-    backoff is used for up to 5 retries.
+    Reports an error the retry policy has given up on. Errors only the user can
+    resolve, such as an invalid key or an exhausted quota, are shown to the user.
+    Anything else is logged as critical and the administrator is emailed.
 
     Args:
         e: an Exception body
-        retry_count: the number of attempts so far
-
-    Returns:
-        retry_count: the number of attemps so far
     """
 
-    unresolvable_user_errors = [
-        openai.BadRequestError,
-        openai.AuthenticationError,
-        openai.NotFoundError,
-        openai.PermissionDeniedError
-    ]
-    error_image = '<img src="/static/alert-light.png" alt="error icon" id="endError">'
     user_folder = getattr(thread_local_storage, "user_folder", None)
     error_code = getattr(e, "status_code", None)
     error_details = {}
     if hasattr(e, "response"):
         json_data = check_json_response(e.response)
-        if json_data is not {}:
+        if json_data:
             error_details = json_data.get("error", {})
     error_message = error_details.get("message", "Unknown error")
     error_logger.error(f"{e}. Error code: {error_code}. Error message: {error_message}")
 
-    if isinstance(e, tuple(unresolvable_user_errors)) or error_code == 401 or "exceeded your current quota" in error_message:
-        if user_folder:
-            training_status[user_folder] = f"{error_image} {error_message}"
-
-    if(isinstance(e, openai.UnprocessableEntityError)):
-        if user_folder:
-            training_status[user_folder] = f"{error_image} A critical error has occured. The administrator has been contacted. Sorry for the inconvience"
-
-    retry_count += 1
-    if retry_count > 5:
-        error_logger("Retry count exceeded")
+    if retry_policy.classify(e) == FATAL and not isinstance(e, openai.UnprocessableEntityError):
         if user_folder:
-            training_status[user_folder] = "A critical error has occured. The administrator has been contacted. Sorry for the inconvience"
+            training_status.add(user_folder, error_message, kind="error")
     else:
-        sleep_time = (5 - retry_count)    + (retry_count ** 2)
-        time.sleep(sleep_time)
-    return retry_count
+        email_admin(e)
+        if user_folder:
+            training_status.add(user_folder, "A critical error has occured. The administrator has been contacted. Sorry for the inconvience", kind="error")
 
-def call_gpt_api(prompt: str, retry_count: Optional[int] = 0) -> str:
+def call_gpt_api(prompt: str) -> str:
     """
-    Makes API calls to the OpenAI ChatCompletions engine.
+    Makes API calls to the OpenAI ChatCompletions engine, retrying according to
+    the shared retry policy. Answers are cached by model, system prompt, prompt and
+    temperature, so unchanged chapters skip the API on repeat runs.
 
     Args:.
         prompt (str): The user's prompt.
-        retry_count (int, optional): The number of retry attempts. Defaults to 0.
 
     Returns:
         str: The generated content from the OpenAI GPT-3 model.
+
+    Raises:
+        Exception: The last error, once the retry policy gives up. The caller
+            reports it with error_handle and raises ReportedError.
     """
-    
-    client = get_client()
 
+    model = "gpt-3.5-turbo-1106"
+    temperature = 0.7
     role_script = (
         "You are an expert develompental editor who specializes in writing scene beats "
         "that are clear and concise. For the following chapter, please reverse engineer "
         "the scene beats for the author. Provide only the beats and not any commentary "
         "the beginning or end."
     )
+    cache_key = beat_cache.make_key(model, role_script, prompt, temperature)
+    cached_answer = beat_cache.get(cache_key)
+    if cached_answer is not None:
+        OPENAI_REQUESTS.inc(endpoint="beats", outcome="cached")
+        return cached_answer
+
+    client = get_client()
+    max_tokens = 1000
     messages = [
             {"role": "system", "content": role_script},
             {"role": "user", "content": prompt}
     ]
 
-    try:
-        response = client.chat.completions.create(
-            model = "gpt-3.5-turbo-1106",
+    attempts = 0
+    usage = None
+
+    def request_beats() -> str:
+        nonlocal attempts, usage
+        attempts += 1
+        rate_limiter.acquire(client.api_key, estimate_tokens(messages, max_tokens))
+        raw_response = client.chat.completions.with_raw_response.create(
+            model = model,
             messages = messages,
-            temperature = 0.7,
-            max_tokens = 1000,
+            temperature = temperature,
+            max_tokens = max_tokens,
         )
+        rate_limiter.update_limits(client.api_key, raw_response.headers)
+        response = raw_response.parse()
+        usage = response.usage
         if response.choices and response.choices[0].message.content:
-            answer = response.choices[0].message.content.strip()
-        else:
-            raise Exception("No message content found")
+            return response.choices[0].message.content.strip()
+        raise Exception("No message content found")
 
-    except Exception as e:
-        retry_count = error_handle(e, retry_count)
-        answer = call_gpt_api(prompt, retry_count)
+    started = time.perf_counter()
+    try:
+        answer = retry_policy.call(request_beats, on_error=log_attempt)
+    except Exception:
+        OPENAI_REQUESTS.inc(endpoint="beats", outcome="error")
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        OPENAI_REQUEST_SECONDS.observe(elapsed, endpoint="beats")
+        usage_tracker.record(
+            "beats", model, usage, elapsed, max(0, attempts - 1),
+            job_id=getattr(thread_local_storage, "user_folder", None)
+        )
+    OPENAI_REQUESTS.inc(endpoint="beats", outcome="success")
+    beat_cache.set(cache_key, answer)
     return answer
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Optional
+
+from finetune.sqlite_db import transaction
+
+error_logger = logging.getLogger("error_logger")
+
+BEATS_CACHE_PATH = os.environ.get(
+    "BEATS_CACHE_PATH", os.path.join(tempfile.gettempdir(), "beats_cache.sqlite3")
+)
+BEATS_CACHE_MAX_BYTES = int(os.environ.get("BEATS_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+
+class BeatCache:
+    """
+    Persistent cache of generated beats, stored in SQLite and keyed by a hash of
+    everything that determines the API's answer. When the stored answers grow
+    past max_bytes, the least recently used entries are evicted. Cache errors are
+    logged and treated as misses so they never fail a job.
+    """
+
+    def __init__(self, path: str = BEATS_CACHE_PATH, max_bytes: int = BEATS_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with transaction(self.path) as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS beats ("
+                    "key TEXT PRIMARY KEY, answer TEXT NOT NULL, "
+                    "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS beats_last_used ON beats (last_used)")
+        except (OSError, sqlite3.Error) as e:
+            error_logger.exception(f"Could not initialize beat cache at {path}: {e}")
+
+    @staticmethod
+    def make_key(model: str, system_prompt: str, prompt: str, temperature: float) -> str:
+        "Hash the inputs of an API call into a cache key."
+        payload = json.dumps([model, system_prompt, prompt, temperature])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key: str) -> Optional[str]:
+        "Return the cached answer for the key, or None on a miss."
+        try:
+            with transaction(self.path) as conn:
+                row = conn.execute("SELECT answer FROM beats WHERE key = ?", (key,)).fetchone()
+                if row:
+                    conn.execute("UPDATE beats SET last_used = ? WHERE key = ?", (time.time(), key))
+        except sqlite3.Error as e:
+            error_logger.exception(f"Beat cache lookup failed: {e}")
+            row = None
+        self._count(hit=row is not None)
+        return row[0] if row else None
+
+    def set(self, key: str, answer: str):
+        "Store an answer and evict least recently used entries over the size limit."
+        size = len(answer.encode("utf-8"))
+        try:
+            with transaction(self.path) as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO beats (key, answer, size, last_used) VALUES (?, ?, ?, ?)",
+                    (key, answer, size, time.time())
+                )
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM beats").fetchone()[0]
+                while total > self.max_bytes:
+                    oldest = conn.execute(
+                        "SELECT key, size FROM beats ORDER BY last_used LIMIT 32"
+                    ).fetchall()
+                    if not oldest:
+                        break
+                    for old_key, old_size in oldest:
+                        conn.execute("DELETE FROM beats WHERE key = ?", (old_key,))
+                        total -= old_size
+                        if total <= self.max_bytes:
+                            break
+        except sqlite3.Error as e:
+            error_logger.exception(f"Beat cache write failed: {e}")
+
+    def stats(self) -> dict:
+        "Return hit and miss counters along with the size of the store."
+        try:
+            with transaction(self.path) as conn:
+                entries, size = conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM beats"
+                ).fetchone()
+        except sqlite3.Error:
+            entries, size = 0, 0
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+
+beat_cache = BeatCache()
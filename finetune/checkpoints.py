@@ -0,0 +1,41 @@
+import json
+import os
+import threading
+from typing import Any
+
+
+class Checkpoint:
+    """
+    Records which stages of a job have completed, in checkpoint.json inside the
+    job folder, so a restarted job can resume from the last completed stage.
+    The file is replaced atomically on every update.
+    """
+
+    FILE_NAME = "checkpoint.json"
+
+    def __init__(self, folder_name: str):
+        self.path = os.path.join(folder_name, self.FILE_NAME)
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, "r") as f:
+                self._stages = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self._stages = {}
+
+    def get(self, stage: str, default: Any = None) -> Any:
+        with self._lock:
+            return self._stages.get(stage, default)
+
+    def set(self, stage: str, value: Any):
+        "Record a completed stage and persist it."
+        with self._lock:
+            self._stages[stage] = value
+            write_atomic(self.path, json.dumps(self._stages))
+
+
+def write_atomic(file_path: str, content: str):
+    "Write a text file so that it either exists complete or not at all."
+    temp_path = f"{file_path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(temp_path, file_path)
@@ -1,97 +1,147 @@
 import os
 import math
+import re
 import time
-from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
 
-from finetune.api_management import call_gpt_api
-from finetune.data_preparation import adjust_to_newline, count_tokens, format_for_finetuning, separate_into_chapters, sliding_window_format, TOKENIZER
+from finetune.api_management import ReportedError, call_gpt_api, error_handle
+from finetune.checkpoints import write_atomic
+from finetune.data_preparation import adjust_to_newline, count_tokens, decode_tokens, format_for_finetuning, separate_into_chapters, sliding_window_format, token_view
+from finetune.openai_client import get_client
+from finetune.shared_resources import thread_local_storage
 
+BEATS_CONCURRENCY = int(os.environ.get("BEATS_CONCURRENCY", 8))
+SENTENCE_EVENTS = re.compile(r'[".?!]')
 
-def generate_beats(book: str) -> list:
+
+def generate_beats(book: str, concurrency: int = BEATS_CONCURRENCY, beats_dir: Optional[str] = None) -> Iterator[Tuple[str, str]]:
     """
-    Generate beats for each chapter in the book using GPT-3.5.
+    Generate beats for each chapter in the book using GPT-3.5, yielding
+    (chapter, user message) pairs.
+
+    Chapter prompts are sent through a thread pool of at most `concurrency`
+    workers, which share the job's client, and the beats are yielded in chapter
+    order. If beats_dir is given, each chapter's beats are checkpointed there as
+    they arrive, and chapters already checkpointed are not sent again.
+
+    The first chapter that fails stops the job: chapters not yet sent are
+    cancelled and the error is reported once, then raised as a ReportedError.
     """
-    user_message_list = []
-    chunk_list = []
     chapters = separate_into_chapters(book)
+    user_folder = getattr(thread_local_storage, "user_folder", None)
+    client = get_client()
+    if beats_dir:
+        os.makedirs(beats_dir, exist_ok=True)
 
-    for chapter in chapters:
-        words = len(chapter.split(" "))
-        prompt = f"Chapter: {chapter}"
-        chapter_beats = call_gpt_api(prompt)
-        user_message_list.append(
-            f"Write {words} words for a chapter with the following scene beats:\n{chapter_beats}"
-        )
-        chunk_list.append(chapter)
-        return chunk_list, user_message_list
+    def chapter_beats(index: int, chapter: str) -> str:
+        "Call the API for one chapter from a worker thread."
+        beats_path = os.path.join(beats_dir, f"{index}.txt") if beats_dir else None
+        if beats_path and os.path.exists(beats_path):
+            with open(beats_path, "r", encoding="utf-8") as f:
+                return f.read()
+        thread_local_storage.user_folder = user_folder
+        thread_local_storage.client = client
+        beats = call_gpt_api(f"Chapter: {chapter}")
+        if beats_path:
+            write_atomic(beats_path, beats)
+        return beats
 
-def extract_dialogue(paragraph: str) -> Tuple[str, str]:
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    try:
+        futures = [executor.submit(chapter_beats, index, chapter) for index, chapter in enumerate(chapters)]
+        for chapter, future in zip(chapters, futures):
+            try:
+                beats = future.result()
+            except Exception as e:
+                executor.shutdown(wait=False, cancel_futures=True)
+                error_handle(e)
+                raise ReportedError(str(e)) from e
+            words = len(chapter.split(" "))
+            yield chapter, f"Write {words} words for a chapter with the following scene beats:\n{beats}"
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def scan_dialogue(paragraph: str) -> Tuple[List[Tuple[int, int]], List[Tuple[int, int]], int, int]:
     """
-    Extract dialogue and prose from a paragraph.
+    Scan a paragraph once for quotes and sentence-ending punctuation.
+
+    Returns the (start, end) offsets of the prose sentences and of the dialogue
+    sentences, and the number of sentence-ending marks in each, which is how
+    sentences are counted.
     """
-    dialogue = ""
-    prose = ""
-    sentence = ""
+    prose_spans = []
+    dialogue_spans = []
+    prose_sentences = 0
+    dialogue_sentences = 0
+    sentence_start = 0
+    sentence_marks = 0
     check_next_char = False
-    end_sentence = False
     in_dialogue = False
-    punctuation = [".", "?", "!"]
     quote_count = 0
+    last_index = len(paragraph) - 1
 
-    for i, char in enumerate(paragraph):
-        sentence += char
-        if char == '"':
+    for match in SENTENCE_EVENTS.finditer(paragraph):
+        i = match.start()
+        if paragraph[i] == '"':
             quote_count += 1
-            in_dialogue = True if (quote_count // 2 == 1) else False
-            end_sentence = True if check_next_char is True else False
+            in_dialogue = quote_count // 2 == 1
+            end_sentence = check_next_char
             check_next_char = False
-        if char in punctuation:
-            if i + 1 < len(paragraph):
+        else:
+            sentence_marks += 1
+            if i < last_index:
                 check_next_char = True
                 continue
             end_sentence = True
-        if end_sentence is True:
-            if in_dialogue is False:
-                prose += sentence.strip()
-            elif in_dialogue is True:
-                dialogue += sentence.strip()
-            sentence = ""
-            end_sentence = False
-    return prose, dialogue
-
-def dialogue_prose(book: str) -> list:
-    """
-    Split the book into prose and dialogue chunks.
-    """
-    chunk_list = []
-    user_message_list = []
-    punctuation = [".", "?", "!"]
+        if end_sentence:
+            if in_dialogue:
+                dialogue_spans.append((sentence_start, i + 1))
+                dialogue_sentences += sentence_marks
+            else:
+                prose_spans.append((sentence_start, i + 1))
+                prose_sentences += sentence_marks
+            sentence_start = i + 1
+            sentence_marks = 0
+    return prose_spans, dialogue_spans, prose_sentences, dialogue_sentences
+
+def join_spans(paragraph: str, spans: List[Tuple[int, int]]) -> str:
+    """
+    Join the stripped sentences at the given offsets of a paragraph.
+    """
+    return "".join(paragraph[start:end].strip() for start, end in spans)
+
+def extract_dialogue(paragraph: str) -> Tuple[str, str]:
+    """
+    Extract dialogue and prose from a paragraph.
+    """
+    prose_spans, dialogue_spans, _, _ = scan_dialogue(paragraph)
+    return join_spans(paragraph, prose_spans), join_spans(paragraph, dialogue_spans)
+
+def dialogue_prose(book: str) -> Iterator[Tuple[str, str]]:
+    """
+    Split the book into prose and dialogue chunks, yielding (chunk, user message)
+    pairs.
+    """
     chapters = separate_into_chapters(book)
 
     for chapter in chapters:
         paragraphs = chapter.split("\n")
         for paragraph in paragraphs:
-            prose_sentences = 0
-            dialogue_sentences = 0
-            prose, dialogue = extract_dialogue(paragraph)
-            for mark in punctuation:
-                prose_sentences += prose.count(mark)
-                p_sentence = "sentence" if prose_sentences == 1 else "sentences"
-                dialogue_sentences += dialogue.count(mark)
-                d_sentence = "sentence" if dialogue_sentences == 1 else "sentences"
+            prose_spans, dialogue_spans, prose_sentences, dialogue_sentences = scan_dialogue(paragraph)
+            p_sentence = "sentence" if prose_sentences == 1 else "sentences"
+            d_sentence = "sentence" if dialogue_sentences == 1 else "sentences"
+            prose = join_spans(paragraph, prose_spans)
+            dialogue = join_spans(paragraph, dialogue_spans)
             if prose:
-                chunk_list.append(prose)
-                user_message_list.append(f"Write {prose_sentences} {p_sentence} of description and action")
+                yield prose, f"Write {prose_sentences} {p_sentence} of description and action"
             if dialogue:
-                chunk_list.append(dialogue)
-                user_message_list.append(f"Write {dialogue_sentences} {d_sentence} of dialogue")
-    return chunk_list, user_message_list
+                yield dialogue, f"Write {dialogue_sentences} {d_sentence} of dialogue"
 
-def sliding_window_large(book: str) -> list:
+def sliding_window_large(book: str) -> Iterator[str]:
     """
     Split the book into chunks of 4096 tokens.
     """
-    chunk_list = []
     chunk_size = 4096
     start_index = 0
     tokens, num_tokens = count_tokens(book)
@@ -100,17 +150,14 @@ def sliding_window_large(book: str) -> list:
         end_index = min(start_index + chunk_size, num_tokens)
         # Adjust end_index to the last newline token in the chunk
         if end_index < num_tokens:
-            end_index = adjust_to_newline(tokens, end_index)
-        chunk_tokens = tokens[start_index:end_index]
-        chunk_list.append(TOKENIZER.decode(chunk_tokens))
+            end_index = adjust_to_newline(tokens, end_index, start_index)
+        yield decode_tokens(token_view(tokens, start_index, end_index))
         start_index = end_index
-    return chunk_list
 
-def sliding_window_small(book: str) -> list:
+def sliding_window_small(book: str) -> Iterator[str]:
     """
     Split the book into chunks of 1/3 of the chapter size, up to 4096 tokens.
     """
-    chunk_list = []
     chapters = separate_into_chapters(book)
 
     for chapter in chapters:
@@ -122,31 +169,21 @@ def sliding_window_small(book: str) -> list:
             end_index = min(start_index + chunk_size, chapter_token_count)
             # Adjust end_index to the last newline token in the chunk
             if end_index < chapter_token_count:
-                #end_index = adjust_to_newline(tokens, end_index)
-                pass
-            chunk_tokens = tokens[start_index:end_index]
-            chunk_list.append(TOKENIZER.decode(chunk_tokens))
+                end_index = adjust_to_newline(tokens, end_index, start_index)
+            yield decode_tokens(token_view(tokens, start_index, end_index))
             start_index = end_index
-    return chunk_list
 
-def split_into_chunks(book: str, role: str, chunk_type: str) -> list:
+def split_into_chunks(book: str, role: str, chunk_type: str, beats_concurrency: int = BEATS_CONCURRENCY, beats_dir: Optional[str] = None) -> Iterator[dict]:
     """
-    Split the book into chunks of the specified type.
+    Split the book into chunks of the specified type, yielding formatted
+    messages as they are produced. Generated beats are checkpointed in
+    beats_dir, if given.
     """
-    chunks = []
-    user_messages = []
     if chunk_type == "sliding_window_small":
-        chunks = sliding_window_small(book)
+        yield from sliding_window_format(sliding_window_small(book), role)
     if chunk_type == "sliding_window_large":
-        chunks = sliding_window_large(book)
+        yield from sliding_window_format(sliding_window_large(book), role)
     if chunk_type == "dialogue_prose":
-        chunks, user_messages = dialogue_prose(book)
+        yield from format_for_finetuning(dialogue_prose(book), role)
     if chunk_type == "generate_beats":
-        chunks, user_messages = generate_beats(book)
-
-    formatted_messages = (
-        sliding_window_format(chunks, role)
-        if "sliding" in chunk_type else 
-        format_for_finetuning(chunks, user_messages, role)
-    )
-    return formatted_messages
+        yield from format_for_finetuning(generate_beats(book, beats_concurrency, beats_dir), role)
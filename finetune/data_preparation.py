@@ -1,45 +1,84 @@
 import re
-from collections import deque
-from typing import List, Tuple
+from array import array
+from typing import Iterable, Iterator, List, Tuple
 
 import tiktoken
 
+from metrics import STAGE_SECONDS
+
 TOKENIZER = tiktoken.get_encoding("cl100k_base")
+END_PARAGRAPH_TOKENS = frozenset({198, 627, 4999, 5380, 702, 10246, 25765, 48469, 34184, 1270, 7058, 7233, 11192})
+
+# Token ids are stored as unsigned 32-bit ints (4 bytes each) rather than a list
+# of Python ints (~36 bytes each), and shared between chunkers as memoryviews.
+TokenBuffer = array
+# The end tokens as they are packed in a TokenBuffer, for searching its bytes
+END_PARAGRAPH_NEEDLES = tuple(array("I", [token]).tobytes() for token in sorted(END_PARAGRAPH_TOKENS))
+# Tokens before a chunk's end checked one by one before the rest is searched
+NEWLINE_SCAN_TOKENS = 256
 
-def count_tokens(text: str) -> Tuple[List[int], int]:
+def count_tokens(text: str) -> Tuple[TokenBuffer, int]:
     """
-    Uses Tiktoken tokenizer to tokenize text and count the number of tokens
+    Uses Tiktoken tokenizer to tokenize text and count the number of tokens.
+    The tokens are returned as a compact TokenBuffer.
     """
-    tokens = TOKENIZER.encode(text)
+    with STAGE_SECONDS.time(stage="tokenization"):
+        tokens = array("I", TOKENIZER.encode(text))
     num_tokens = len(tokens)
     return tokens, num_tokens
 
-def adjust_to_newline(tokens: List[int], end_index: int) -> int:
+def token_view(tokens: TokenBuffer, start_index: int, end_index: int) -> memoryview:
+    """
+    Returns a zero-copy view of tokens[start_index:end_index]
+    """
+    return memoryview(tokens)[start_index:end_index]
+
+def decode_tokens(tokens: memoryview) -> str:
     """
-    Adjusts the end index to the end of the last paragraph, based on token ids
-    indicating the end of a paragraph
+    Decodes a view of a TokenBuffer back into text
     """
-    end_paragraph_tokens = [198, 627, 4999, 5380, 702, 10246, 25765, 48469, 34184, 1270, 7058, 7233, 11192]
-    while end_index > 0 and tokens[end_index - 1] not in end_paragraph_tokens:
-        end_index -= 1
-    return end_index
+    return TOKENIZER.decode(tokens.tolist())
+
+def adjust_to_newline(tokens: TokenBuffer, end_index: int, start_index: int = 0) -> int:
+    """
+    Adjusts the end index to the end of the last paragraph before it. Paragraphs
+    are usually short, so the NEWLINE_SCAN_TOKENS tokens before end_index are
+    checked one by one first; only if none of them ends a paragraph is the rest
+    of the chunk searched, with bytes.rfind for each end token. If no paragraph
+    ends after start_index, the end index is returned unchanged.
+    """
+    scan_stop = max(start_index, end_index - NEWLINE_SCAN_TOKENS)
+    for index in range(end_index, scan_stop, -1):
+        if tokens[index - 1] in END_PARAGRAPH_TOKENS:
+            return index
+
+    data = memoryview(tokens)[start_index:scan_stop].tobytes()
+    width = tokens.itemsize
+    last = -1
+    for needle in END_PARAGRAPH_NEEDLES:
+        # Only search past the latest end token found so far
+        offset = data.rfind(needle, last + 1)
+        while offset != -1 and offset % width:
+            # A match across two tokens; look for one further back
+            offset = data.rfind(needle, last + 1, offset + width - 1)
+        last = max(last, offset)
+    if last == -1:
+        return end_index
+    return start_index + last // width + 1
 
-def format_for_finetuning(chunks: list, user_messages: list, role: str) -> list:
+def format_for_finetuning(chunks: Iterable[Tuple[str, str]], role: str) -> Iterator[dict]:
     """
-    Formats chunked data for finetuning
+    Formats chunked data for finetuning. Takes (chunk, user message) pairs and
+    yields one formatted example per pair.
     """
-    formatted_data = []
-    for i, chunk in enumerate(chunks):
-        user_content = user_messages[i]
-        message = {
+    for chunk, user_content in chunks:
+        yield {
             "messages": [
                 {"role": "system", "content": role},
                 {"role": "user", "content": user_content},
                 {"role": "assistant", "content": chunk}
             ]
         }
-        formatted_data.append(message)
-    return formatted_data
 
 def separate_into_chapters(text: str) -> List:
     """
@@ -47,22 +86,20 @@ def separate_into_chapters(text: str) -> List:
     """
     return re.split(r"\s*\*\*\s*", text)
 
-def sliding_window_format(chunks: list, role: str) -> list:
+def sliding_window_format(chunks: Iterable[str], role: str) -> Iterator[dict]:
     """
-    Formats chunked data for finetuning using a sliding window approach
+    Formats chunked data for finetuning using a sliding window approach, yielding
+    each chunk as the user message for the chunk that follows it
     """
-    formatted_data = []
-    queue = deque(chunks)
+    chunk_iter = iter(chunks)
+    user_message = next(chunk_iter, None)
 
-    while len(queue) > 1:
-        user_message = queue.popleft()
-        assistant_message = queue[0]
-        message = {
+    for assistant_message in chunk_iter:
+        yield {
             "messages": [
                 {"role": "system", "content": role},
                 {"role": "user", "content": user_message},
                 {"role": "assistant", "content": assistant_message}
             ]
         }
-        formatted_data.append(message)
-    return formatted_data
+        user_message = assistant_message
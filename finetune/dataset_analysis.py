@@ -0,0 +1,139 @@
+import json
+import os
+from array import array
+from bisect import bisect_right
+from typing import Iterable, Iterator, List
+
+from finetune.data_preparation import TOKENIZER
+
+# Longest example, in tokens, that gpt-3.5-turbo-1106 can be fine-tuned on
+FINETUNE_CONTEXT_LIMIT = int(os.environ.get("FINETUNE_CONTEXT_LIMIT", 16385))
+TRAINING_PRICE_PER_1K_TOKENS = float(os.environ.get("TRAINING_PRICE_PER_1K_TOKENS", 0.008))
+MIN_EXAMPLES = 10
+
+# Formatting overhead of the chat format, as counted by OpenAI's cookbook
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+# Bounds OpenAI uses to choose the default number of epochs
+TARGET_EPOCHS = 3
+MIN_TARGET_EXAMPLES = 100
+MAX_TARGET_EXAMPLES = 25000
+MIN_DEFAULT_EPOCHS = 1
+MAX_DEFAULT_EPOCHS = 25
+TEXT_CACHE_SIZE = 32
+
+
+def tally_tokens(examples: Iterable[dict], counts: array) -> Iterator[dict]:
+    """
+    Passes formatted examples through unchanged, appending the number of tokens
+    in each to counts.
+
+    The system message repeats in every example, and sliding window chunks are
+    the assistant message of one example and the user message of the next, so
+    the last few texts are remembered rather than encoded again.
+    """
+    cache = {}
+    for example in examples:
+        tokens = TOKENS_PER_REPLY
+        for message in example["messages"]:
+            tokens += TOKENS_PER_MESSAGE
+            for value in message.values():
+                length = cache.get(value)
+                if length is None:
+                    if len(cache) >= TEXT_CACHE_SIZE:
+                        cache.clear()
+                    length = cache[value] = len(TOKENIZER.encode_ordinary(value))
+                tokens += length
+        counts.append(tokens)
+        yield example
+
+def write_token_counts(counts: array, file_path: str):
+    "Writes token counts as a compact binary file."
+    with open(file_path, "wb") as f:
+        counts.tofile(f)
+
+def read_token_counts(part_path: str) -> array:
+    """
+    Reads the token counts saved next to a JSONL file, counting them from the
+    JSONL file itself if they were never saved.
+    """
+    counts = array("I")
+    counts_path = f"{part_path}.tokens"
+    if os.path.exists(counts_path):
+        with open(counts_path, "rb") as f:
+            counts.frombytes(f.read())
+        return counts
+    with open(part_path, "r") as f:
+        for _ in tally_tokens((json.loads(line) for line in f if line.strip()), counts):
+            pass
+    return counts
+
+def default_epochs(n_examples: int) -> int:
+    "The number of epochs OpenAI trains for when none is given."
+    if n_examples * TARGET_EPOCHS < MIN_TARGET_EXAMPLES:
+        return min(MAX_DEFAULT_EPOCHS, MIN_TARGET_EXAMPLES // n_examples)
+    if n_examples * TARGET_EPOCHS > MAX_TARGET_EXAMPLES:
+        return max(MIN_DEFAULT_EPOCHS, MAX_TARGET_EXAMPLES // n_examples)
+    return TARGET_EPOCHS
+
+
+class DatasetReport:
+    """
+    Token statistics of a fine-tuning dataset, the estimated cost of training on
+    it, and the problems that would make OpenAI reject it.
+    """
+
+    def __init__(self, counts: array, limit: int = FINETUNE_CONTEXT_LIMIT):
+        ordered = sorted(counts)
+        self.examples = len(ordered)
+        self.total_tokens = sum(ordered)
+        self.limit = limit
+        self.over_limit = self.examples - bisect_right(ordered, limit)
+        if ordered:
+            self.min_tokens = ordered[0]
+            self.max_tokens = ordered[-1]
+            self.mean_tokens = self.total_tokens / self.examples
+            self.median_tokens = ordered[self.examples // 2]
+            self.p95_tokens = ordered[min(self.examples - 1, int(self.examples * 0.95))]
+            self.epochs = default_epochs(self.examples)
+        else:
+            self.min_tokens = self.max_tokens = self.median_tokens = self.p95_tokens = 0
+            self.mean_tokens = 0.0
+            self.epochs = 0
+        self.billed_tokens = sum(min(limit, tokens) for tokens in ordered) * self.epochs
+        self.estimated_cost = self.billed_tokens / 1000 * TRAINING_PRICE_PER_1K_TOKENS
+
+    @property
+    def errors(self) -> List[str]:
+        "Reasons the dataset cannot be fine-tuned on, if any."
+        errors = []
+        if self.examples < MIN_EXAMPLES:
+            errors.append(
+                f"The dataset has {self.examples} examples, but fine-tuning needs at least "
+                f"{MIN_EXAMPLES}. Please upload more text."
+            )
+        if self.over_limit:
+            errors.append(
+                f"{self.over_limit} examples are longer than the {self.limit:,} token limit "
+                f"(longest {self.max_tokens:,} tokens). Please use a smaller chunk type or "
+                "shorter chapters."
+            )
+        return errors
+
+    def summary(self) -> str:
+        return (
+            f"Dataset: {self.examples:,} examples, {self.total_tokens:,} tokens "
+            f"(per example min {self.min_tokens:,}, median {self.median_tokens:,}, "
+            f"mean {self.mean_tokens:,.0f}, 95th percentile {self.p95_tokens:,}, "
+            f"max {self.max_tokens:,}). Estimated training cost ${self.estimated_cost:,.2f} "
+            f"for {self.epochs} epochs."
+        )
+
+
+def analyze_dataset(part_paths: Iterable[str]) -> DatasetReport:
+    "Builds the report for a dataset made of the given JSONL files."
+    counts = array("I")
+    for part_path in part_paths:
+        counts.extend(read_token_counts(part_path))
+    return DatasetReport(counts)
@@ -0,0 +1,193 @@
+import heapq
+import logging
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+from openai import OpenAI
+
+from finetune.rate_limiter import rate_limiter
+from finetune.retry import FATAL, retry_policy
+from finetune.shared_resources import training_status
+from metrics import FINETUNE_SECONDS
+
+error_logger = logging.getLogger("error_logger")
+info_logger = logging.getLogger("info_logger")
+
+MIN_POLL_SECONDS = float(os.environ.get("FINETUNE_MIN_POLL_SECONDS", 5))
+MAX_POLL_SECONDS = float(os.environ.get("FINETUNE_MAX_POLL_SECONDS", 120))
+POLL_BACKOFF = 1.5
+EVENTS_PAGE_SIZE = 50
+MAX_EVENT_PAGES = 10
+TERMINAL_STATUSES = ("succeeded", "failed", "cancelled")
+
+
+class MonitoredJob:
+    """
+    A fine-tuning job being watched, with its event cursor, poll interval and
+    the callbacks told about its progress.
+    """
+
+    def __init__(self, job_id: str, client: OpenAI, user_folder: str, last_event_id: Optional[str] = None,
+                 on_events: Optional[Callable[[str], None]] = None, on_finish: Optional[Callable[[str], None]] = None):
+        self.job_id = job_id
+        self.client = client
+        self.user_folder = user_folder
+        self.last_event_id = last_event_id
+        self.on_events = on_events
+        self.on_finish = on_finish
+        self.interval = MIN_POLL_SECONDS
+        self.started_at = time.monotonic()
+
+
+class JobMonitor:
+    """
+    Watches every active fine-tuning job from a single background thread.
+
+    Jobs are kept in a heap ordered by their next poll time. Each poll pages
+    through the events created since the last one seen and adds them to the
+    training status. A job is polled every MIN_POLL_SECONDS while events keep
+    arriving, backing off to MAX_POLL_SECONDS during long quiet stretches of
+    training.
+
+    A job's on_events callback is given the id of the newest event seen after
+    each poll that found events, and its on_finish callback the job's final
+    status ("succeeded", "failed", "cancelled", or "error" if monitoring had to
+    stop), so the caller can persist monitoring across restarts.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self._schedule = []
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def watch(self, job_id: str, client: OpenAI, user_folder: str, last_event_id: Optional[str] = None,
+              on_events: Optional[Callable[[str], None]] = None, on_finish: Optional[Callable[[str], None]] = None):
+        """
+        Start monitoring a fine-tuning job on behalf of the given user folder.
+        Events up to last_event_id have already been reported.
+        """
+        with self._condition:
+            self._jobs[job_id] = MonitoredJob(job_id, client, user_folder, last_event_id, on_events, on_finish)
+            heapq.heappush(self._schedule, (time.monotonic(), job_id))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="job-monitor", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def active_jobs(self) -> int:
+        with self._condition:
+            return len(self._jobs)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._schedule:
+                    self._condition.wait()
+                next_poll, job_id = self._schedule[0]
+                wait = next_poll - time.monotonic()
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+                heapq.heappop(self._schedule)
+                job = self._jobs.get(job_id)
+            if job is None:
+                continue
+
+            try:
+                finished = self._poll(job)
+            except Exception as e:
+                finished = self._handle_error(job, e)
+
+            with self._condition:
+                if finished:
+                    self._jobs.pop(job_id, None)
+                else:
+                    heapq.heappush(self._schedule, (time.monotonic() + job.interval, job_id))
+
+    def _notify(self, callback: Optional[Callable[[str], None]], value: str):
+        "Call a job's callback, which must never stop the monitor."
+        if callback is None:
+            return
+        try:
+            callback(value)
+        except Exception as e:
+            error_logger.exception(f"Fine-tuning job callback failed: {e}")
+
+    def _request(self, job: MonitoredJob, func, *args, **kwargs):
+        rate_limiter.acquire(job.client.api_key)
+        return func(*args, **kwargs)
+
+    def _new_events(self, job: MonitoredJob) -> list:
+        """
+        Returns the job's events since the last one seen, oldest first. Events are
+        listed newest first, so pages are followed with the `after` cursor until
+        the last seen event is reached.
+        """
+        events = []
+        after = None
+        for _ in range(MAX_EVENT_PAGES):
+            params = {"fine_tuning_job_id": job.job_id, "limit": EVENTS_PAGE_SIZE}
+            if after:
+                params["after"] = after
+            page = self._request(job, job.client.fine_tuning.jobs.list_events, **params)
+            for event in page.data:
+                if event.id == job.last_event_id:
+                    events.reverse()
+                    return events
+                events.append(event)
+            if len(page.data) < EVENTS_PAGE_SIZE:
+                break
+            after = page.data[-1].id
+        events.reverse()
+        return events
+
+    def _poll(self, job: MonitoredJob) -> bool:
+        "Poll one job, returning True once it has finished."
+        fine_tune_info = self._request(job, job.client.fine_tuning.jobs.retrieve, job.job_id)
+        events = self._new_events(job)
+        for event in events:
+            training_status.add(job.user_folder, event.message)
+        if events:
+            job.last_event_id = events[-1].id
+            job.interval = MIN_POLL_SECONDS
+            self._notify(job.on_events, job.last_event_id)
+        else:
+            job.interval = min(MAX_POLL_SECONDS, job.interval * POLL_BACKOFF)
+
+        if fine_tune_info.status not in TERMINAL_STATUSES:
+            return False
+        if fine_tune_info.status == "succeeded":
+            training_status.add(job.user_folder, fine_tune_info.status)
+            training_status.add(job.user_folder, f"Model id {fine_tune_info.fine_tuned_model}")
+            trained_tokens = getattr(fine_tune_info, "trained_tokens", None)
+            if trained_tokens:
+                training_status.add(job.user_folder, f"Trained tokens: {trained_tokens:,}")
+        else:
+            error = getattr(fine_tune_info, "error", None)
+            message = getattr(error, "message", None) or f"Fine-tuning {fine_tune_info.status}"
+            training_status.add(job.user_folder, message, kind="error")
+        training_status.finish(job.user_folder)
+        FINETUNE_SECONDS.observe(time.monotonic() - job.started_at, status=fine_tune_info.status)
+        info_logger.info(f"Fine-tuning job {job.job_id} {fine_tune_info.status}")
+        self._notify(job.on_finish, fine_tune_info.status)
+        return True
+
+    def _handle_error(self, job: MonitoredJob, e: Exception) -> bool:
+        """
+        Errors only the user can fix stop monitoring the job. Anything else is
+        retried at the next, backed off, poll.
+        """
+        error_logger.error(f"Monitoring fine-tuning job {job.job_id} failed: {e}")
+        if retry_policy.classify(e) == FATAL:
+            training_status.add(job.user_folder, getattr(e, "message", str(e)), kind="error")
+            training_status.finish(job.user_folder)
+            self._notify(job.on_finish, "error")
+            return True
+        job.interval = min(MAX_POLL_SECONDS, job.interval * POLL_BACKOFF)
+        return False
+
+
+job_monitor = JobMonitor()
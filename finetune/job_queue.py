@@ -0,0 +1,341 @@
+import base64
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from functools import partial
+from typing import Optional
+
+from cryptography.fernet import Fernet, InvalidToken
+
+from finetune.checkpoints import Checkpoint
+from finetune.chunking import BEATS_CONCURRENCY
+from finetune.job_monitor import job_monitor
+from finetune.openai_client import get_client
+from finetune.shared_resources import training_status
+from finetune.sqlite_db import enable_wal, transaction
+from finetune.training_management import train
+from metrics import JOB_QUEUE_SECONDS, JOB_RUN_SECONDS, Gauge
+
+error_logger = logging.getLogger("error_logger")
+info_logger = logging.getLogger("info_logger")
+
+JOB_QUEUE_PATH = os.environ.get(
+    "JOB_QUEUE_PATH", os.path.join(tempfile.gettempdir(), "finetune_jobs.sqlite3")
+)
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+MAX_QUEUED_JOBS = int(os.environ.get("MAX_QUEUED_JOBS", 50))
+# Failed jobs can be requeued for this long before they are forgotten
+FAILED_JOB_TTL = int(os.environ.get("FAILED_JOB_TTL", 7 * 24 * 60 * 60))
+QUEUE_POLL_SECONDS = 5
+
+QUEUED = "queued"
+RUNNING = "running"
+MONITORING = "monitoring"
+FAILED = "failed"
+
+
+class QueueFull(Exception):
+    "Raised when a job is submitted while the queue is at capacity."
+
+
+class JobNotFound(Exception):
+    "Raised when a job to requeue is unknown or has not failed."
+
+
+def _get_cipher() -> Fernet:
+    """
+    Returns the cipher used to keep users' API keys encrypted while their jobs
+    wait in the queue, derived from the Flask secret key.
+    """
+    secret = os.environ.get("FLASK_SECRET_KEY", "")
+    return Fernet(base64.urlsafe_b64encode(hashlib.sha256(secret.encode("utf-8")).digest()))
+
+
+class JobQueue:
+    """
+    Runs fine-tuning jobs on a fixed-size pool of worker threads, fed from a
+    queue persisted in SQLite.
+
+    Jobs beyond max_queued waiting jobs are refused. Waiting jobs see their
+    position in the queue in their training status. Every worker process on the
+    host shares the queue; a running job records the process that owns it, and
+    jobs whose process has died are put back at the front of the queue.
+
+    Once its fine-tuning job has started, a job stays in the queue while the job
+    monitor watches it, along with the last event reported, so another process
+    takes over monitoring if its owner dies. A job's row, along with its
+    encrypted API key, is deleted once fine-tuning succeeds. Jobs that fail keep
+    their row, without the key, for FAILED_JOB_TTL seconds so they can be
+    requeued on the same folder with requeue.
+    """
+
+    def __init__(self, path: str = JOB_QUEUE_PATH, workers: int = JOB_WORKERS, max_queued: int = MAX_QUEUED_JOBS):
+        self.path = path
+        self.workers = workers
+        self.max_queued = max_queued
+        self._cipher = _get_cipher()
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._start_lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        enable_wal(path)
+        with transaction(self.path) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, user_folder TEXT UNIQUE NOT NULL, "
+                "folder_name TEXT NOT NULL, role TEXT NOT NULL, chunk_type TEXT NOT NULL, "
+                "user_key BLOB NOT NULL, state TEXT NOT NULL, owner INTEGER, created_at REAL NOT NULL, "
+                "profile INTEGER NOT NULL DEFAULT 0, fine_tune_job_id TEXT, last_event_id TEXT, updated_at REAL, "
+                "beats_concurrency INTEGER)"
+            )
+            columns = [column[1] for column in conn.execute("PRAGMA table_info(jobs)")]
+            for column, definition in (
+                ("profile", "INTEGER NOT NULL DEFAULT 0"), ("fine_tune_job_id", "TEXT"),
+                ("last_event_id", "TEXT"), ("updated_at", "REAL"), ("beats_concurrency", "INTEGER")
+            ):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+
+    def _requeue_orphans(self):
+        """
+        Put jobs whose owning process is gone back in the queue, take over
+        monitoring the fine-tuning jobs of such processes, and forget failed jobs
+        past FAILED_JOB_TTL.
+        """
+        with transaction(self.path) as conn:
+            conn.execute(
+                "DELETE FROM jobs WHERE state = ? AND updated_at < ?", (FAILED, time.time() - FAILED_JOB_TTL)
+            )
+            running = conn.execute(
+                "SELECT id, owner FROM jobs WHERE state = ?", (RUNNING,)
+            ).fetchall()
+            orphans = [job_id for job_id, owner in running if not self._owner_alive(owner)]
+            for job_id in orphans:
+                conn.execute("UPDATE jobs SET state = ?, owner = NULL WHERE id = ?", (QUEUED, job_id))
+            monitored = conn.execute(
+                "SELECT id, owner, user_folder, folder_name, user_key, fine_tune_job_id, last_event_id "
+                "FROM jobs WHERE state = ?", (MONITORING,)
+            ).fetchall()
+            unwatched = [row for row in monitored if not self._owner_alive(row[1])]
+            for row in unwatched:
+                conn.execute("UPDATE jobs SET owner = ? WHERE id = ?", (os.getpid(), row[0]))
+        if orphans:
+            info_logger.info(f"Requeued {len(orphans)} interrupted fine-tuning jobs")
+        for job_id, _, user_folder, folder_name, encrypted_key, fine_tune_job_id, last_event_id in unwatched:
+            try:
+                user_key = self._cipher.decrypt(encrypted_key).decode("utf-8")
+            except InvalidToken:
+                error_logger.error(f"Could not decrypt the API key of fine-tuning job {user_folder}")
+                training_status.add(user_folder, "Monitoring stopped. Please retry the job with your key.", kind="error")
+                training_status.finish(user_folder)
+                self._fail(job_id)
+                continue
+            training_status.add(user_folder, "Monitoring resumed after a restart")
+            self._watch(job_id, user_folder, folder_name, user_key, fine_tune_job_id, last_event_id)
+        if unwatched:
+            info_logger.info(f"Resumed monitoring {len(unwatched)} fine-tuning jobs")
+
+    def _watch(self, job_id: int, user_folder: str, folder_name: str, user_key: str, fine_tune_job_id: str, last_event_id: Optional[str] = None):
+        "Hand a job's fine-tuning job to the job monitor."
+        job_monitor.watch(
+            fine_tune_job_id, get_client(user_key), user_folder, last_event_id,
+            on_events=partial(self._save_last_event, job_id),
+            on_finish=partial(self._monitoring_finished, job_id, folder_name)
+        )
+
+    def _save_last_event(self, job_id: int, last_event_id: str):
+        with transaction(self.path) as conn:
+            conn.execute("UPDATE jobs SET last_event_id = ? WHERE id = ?", (last_event_id, job_id))
+
+    def _monitoring_finished(self, job_id: int, folder_name: str, status: str):
+        """
+        Delete a job whose fine-tuning succeeded. Otherwise the job fails, and if
+        OpenAI's job failed or was cancelled, a requeued run starts a new one.
+        """
+        if status == "succeeded":
+            with transaction(self.path) as conn:
+                conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            return
+        if status != "error":
+            Checkpoint(folder_name).set("fine_tune_job_id", None)
+        self._fail(job_id)
+
+    def _fail(self, job_id: int):
+        "Keep a failed job, without its API key, so it can be requeued."
+        with transaction(self.path) as conn:
+            conn.execute(
+                "UPDATE jobs SET state = ?, owner = NULL, user_key = ?, updated_at = ? WHERE id = ?",
+                (FAILED, b"", time.time(), job_id)
+            )
+
+    def _owner_alive(self, owner: Optional[int]) -> bool:
+        "Whether the process that claimed a job is still running it."
+        if owner is None:
+            return False
+        if owner == os.getpid():
+            # Only jobs claimed by our own worker threads count as ours
+            return bool(self._threads)
+        try:
+            os.kill(owner, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def start(self):
+        "Requeue jobs interrupted by a restart and start the worker threads."
+        with self._start_lock:
+            if self._threads:
+                return
+            self._requeue_orphans()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, folder_name: str, role: str, user_key: str, chunk_type: str, user_folder: str, profile: bool = False, beats_concurrency: Optional[int] = None) -> int:
+        """
+        Add a job to the queue and return its position. Profiled jobs save a
+        cProfile of their run. beats_concurrency caps the job's concurrent
+        generate_beats requests, defaulting to BEATS_CONCURRENCY.
+
+        Raises:
+            QueueFull: If max_queued jobs are already waiting.
+        """
+        encrypted_key = self._cipher.encrypt(user_key.encode("utf-8"))
+        with transaction(self.path) as conn:
+            queued = conn.execute("SELECT COUNT(*) FROM jobs WHERE state = ?", (QUEUED,)).fetchone()[0]
+            if queued >= self.max_queued:
+                raise QueueFull("Too many jobs are waiting")
+            conn.execute(
+                "INSERT INTO jobs (user_folder, folder_name, role, chunk_type, user_key, state, created_at, profile, beats_concurrency) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (user_folder, folder_name, role, chunk_type, encrypted_key, QUEUED, time.time(), int(profile), beats_concurrency)
+            )
+            # Written before the job is committed, so no worker can start it first
+            position = queued + 1
+            training_status.start(user_folder, f"Queued, position {position}")
+        self.start()
+        self._wakeup.set()
+        return position
+
+    def requeue(self, user_folder: str, user_key: str) -> int:
+        """
+        Put a failed job back in the queue with the user's API key and return its
+        position. The job resumes from its last completed stage.
+
+        Raises:
+            JobNotFound: If the user folder has no failed job.
+            QueueFull: If max_queued jobs are already waiting.
+        """
+        encrypted_key = self._cipher.encrypt(user_key.encode("utf-8"))
+        with transaction(self.path) as conn:
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE user_folder = ? AND state = ?", (user_folder, FAILED)
+            ).fetchone()
+            if row is None:
+                raise JobNotFound(user_folder)
+            queued = conn.execute("SELECT COUNT(*) FROM jobs WHERE state = ?", (QUEUED,)).fetchone()[0]
+            if queued >= self.max_queued:
+                raise QueueFull("Too many jobs are waiting")
+            # The job joins the back of the queue, as jobs are taken in created_at order
+            now = time.time()
+            conn.execute(
+                "UPDATE jobs SET state = ?, user_key = ?, created_at = ?, updated_at = ? WHERE id = ?",
+                (QUEUED, encrypted_key, now, now, row[0])
+            )
+            position = queued + 1
+            training_status.start(user_folder, f"Queued, position {position}")
+        self.start()
+        self._wakeup.set()
+        return position
+
+    def depth(self) -> int:
+        "Number of jobs waiting to run."
+        with transaction(self.path, write=False) as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE state = ?", (QUEUED,)).fetchone()[0]
+
+    def running(self) -> int:
+        "Number of jobs currently running."
+        with transaction(self.path, write=False) as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE state = ?", (RUNNING,)).fetchone()[0]
+
+    def _claim(self) -> Optional[tuple]:
+        """
+        Atomically take the job that has waited longest, or return None if there
+        is none. Jobs are ordered by when they were queued, so a retried job
+        waits behind the jobs queued before it.
+        """
+        with transaction(self.path) as conn:
+            row = conn.execute(
+                "SELECT id, user_folder, folder_name, role, chunk_type, user_key, profile, beats_concurrency, created_at FROM jobs "
+                "WHERE state = ? ORDER BY created_at, id LIMIT 1", (QUEUED,)
+            ).fetchone()
+            if row:
+                conn.execute(
+                    "UPDATE jobs SET state = ?, owner = ? WHERE id = ?", (RUNNING, os.getpid(), row[0])
+                )
+                waiting = conn.execute(
+                    "SELECT user_folder FROM jobs WHERE state = ? ORDER BY created_at, id", (QUEUED,)
+                ).fetchall()
+                # Before committing, so another worker cannot start one of these jobs first
+                for position, (waiting_folder,) in enumerate(waiting, start=1):
+                    training_status.add(waiting_folder, f"Queued, position {position}")
+        if not row:
+            return None
+        JOB_QUEUE_SECONDS.observe(max(0.0, time.time() - row[-1]))
+        return row[:-1]
+
+    def _work(self):
+        while True:
+            try:
+                job = self._claim()
+            except sqlite3.Error as e:
+                error_logger.exception(f"Could not read the job queue: {e}")
+                job = None
+            if job is None:
+                try:
+                    self._requeue_orphans()
+                except sqlite3.Error as e:
+                    error_logger.exception(f"Could not recover orphaned jobs: {e}")
+                self._wakeup.wait(QUEUE_POLL_SECONDS)
+                self._wakeup.clear()
+                continue
+
+            job_id, user_folder, folder_name, role, chunk_type, encrypted_key, profile, beats_concurrency = job
+            fine_tune_job_id = None
+            try:
+                user_key = self._cipher.decrypt(encrypted_key).decode("utf-8")
+                with JOB_RUN_SECONDS.time():
+                    fine_tune_job_id = train(
+                        folder_name, role, user_key, chunk_type, user_folder,
+                        beats_concurrency=beats_concurrency or BEATS_CONCURRENCY, profile=bool(profile)
+                    )
+                if fine_tune_job_id is not None:
+                    self._watch(job_id, user_folder, folder_name, user_key, fine_tune_job_id)
+                    # Monitoring may already have finished, and updated the job
+                    with transaction(self.path) as conn:
+                        conn.execute(
+                            "UPDATE jobs SET state = ?, fine_tune_job_id = ?, updated_at = ? WHERE id = ? AND state = ?",
+                            (MONITORING, fine_tune_job_id, time.time(), job_id, RUNNING)
+                        )
+            except Exception as e:
+                error_logger.exception(f"Fine-tuning job {user_folder} failed: {e}")
+            finally:
+                if fine_tune_job_id is None:
+                    try:
+                        self._fail(job_id)
+                    except sqlite3.Error as e:
+                        error_logger.exception(f"Could not mark job {user_folder} failed: {e}")
+
+
+job_queue = JobQueue()
+
+Gauge("prosepal_queued_jobs", "Fine-tuning jobs waiting in the job queue.", function=job_queue.depth)
+Gauge("prosepal_running_jobs", "Fine-tuning jobs being prepared by queue workers.", function=job_queue.running)
+Gauge("prosepal_monitored_jobs", "OpenAI fine-tuning jobs watched by this worker's job monitor.", function=job_monitor.active_jobs)
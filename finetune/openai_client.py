@@ -1,10 +1,60 @@
+import hashlib
+import os
+import threading
+import time
+from typing import Optional
+
+import httpx
 from openai import OpenAI
 
-client = None
+from finetune.shared_resources import thread_local_storage
+
+# Clients unused for this long are dropped from the registry
+CLIENT_IDLE_SECONDS = int(os.environ.get("OPENAI_CLIENT_IDLE_SECONDS", 900))
+
+# One connection pool shared by every client, so keep-alive connections to the
+# API are reused across keys, jobs and threads
+http_client = httpx.Client(
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60),
+    timeout=httpx.Timeout(600, connect=10)
+)
+
+_clients = {}
+_clients_lock = threading.Lock()
 
-def set_client(api_key:str):
-    global client
-    client = OpenAI(api_key = api_key)
 
-def get_client():
+def _evict_idle_clients(now: float):
+    """
+    Drops clients that have not been used recently. They share the pooled HTTP
+    client, so they are released rather than closed.
+    """
+    for key, (_, last_used) in list(_clients.items()):
+        if now - last_used > CLIENT_IDLE_SECONDS:
+            del _clients[key]
+
+def get_client(api_key: Optional[str] = None) -> Optional[OpenAI]:
+    """
+    Returns the pooled client for api_key, creating it if needed. Without a key,
+    returns the client bound to the current thread by set_client.
+    """
+    if api_key is None:
+        return getattr(thread_local_storage, "client", None)
+
+    key = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+    now = time.monotonic()
+    with _clients_lock:
+        _evict_idle_clients(now)
+        if key in _clients:
+            client = _clients[key][0]
+        else:
+            client = OpenAI(api_key=api_key, max_retries=0, http_client=http_client)
+        _clients[key] = (client, now)
     return client
+
+def set_client(api_key: Optional[str]) -> Optional[OpenAI]:
+    """
+    Binds the pooled client for api_key to the current thread, so calls made on
+    behalf of a job never see another job's key. Pass None to unbind.
+    """
+    thread_local_storage.client = get_client(api_key) if api_key else None
+    return thread_local_storage.client
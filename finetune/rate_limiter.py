@@ -0,0 +1,183 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Mapping, Optional
+
+from finetune.sqlite_db import enable_wal, transaction
+
+error_logger = logging.getLogger("error_logger")
+
+# Limits assumed for a key until its responses report the real ones
+OPENAI_RPM_LIMIT = int(os.environ.get("OPENAI_RPM_LIMIT", 3500))
+OPENAI_TPM_LIMIT = int(os.environ.get("OPENAI_TPM_LIMIT", 60000))
+# Fraction of the account limits to use, so throughput settles just under them
+RATE_LIMIT_HEADROOM = float(os.environ.get("RATE_LIMIT_HEADROOM", 0.9))
+# Buckets are shared by every worker process on the host through this database
+RATE_LIMIT_DB_PATH = os.environ.get(
+    "RATE_LIMIT_DB_PATH", os.path.join(tempfile.gettempdir(), "openai_rate_limits.sqlite3")
+)
+IMAGE_TOKENS = 85  # cost of a low detail image
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class TokenBucket:
+    """
+    Bucket holding up to one minute of capacity, refilled continuously. Levels
+    are timestamped with the wall clock, so a bucket can be saved by one process
+    and refilled by another.
+    """
+
+    def __init__(self, per_minute: float, level: Optional[float] = None, updated: Optional[float] = None):
+        self.capacity = per_minute
+        self.level = per_minute if level is None else min(level, per_minute)
+        self.refill_rate = per_minute / 60
+        self.updated = time.time() if updated is None else updated
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + max(0.0, now - self.updated) * self.refill_rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        "Seconds until the bucket holds the amount, capped at its capacity."
+        self._refill(now)
+        shortfall = min(amount, self.capacity) - self.level
+        return shortfall / self.refill_rate if shortfall > 0 else 0
+
+    def take(self, amount: float):
+        self.level -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    """
+    Client-side limiter tracking requests per minute and tokens per minute for
+    each API key. Callers block in acquire until both buckets have capacity.
+
+    The buckets are kept in a SQLite database, so every worker process on the
+    host draws on the same limits. Each key starts with the default limits and
+    learns its own from the x-ratelimit-limit-* headers of its responses. Keys
+    are only held as hashes. Database errors are logged and let the request
+    through, so the limiter never fails a job.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float, path: str = RATE_LIMIT_DB_PATH):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.path = path
+        self._known_limits = {}
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def _setup(self):
+        "Create the database on first use, so importing the limiter opens nothing."
+        with self._lock:
+            if self._ready:
+                return
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            enable_wal(self.path)
+            with transaction(self.path) as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS rate_limits ("
+                    "key TEXT PRIMARY KEY, requests_per_minute REAL NOT NULL, tokens_per_minute REAL NOT NULL, "
+                    "request_level REAL NOT NULL, token_level REAL NOT NULL, updated REAL NOT NULL)"
+                )
+            self._ready = True
+
+    def _try_acquire(self, key: str, tokens: int) -> float:
+        "Take one request and the tokens if both are available, or return the seconds to wait."
+        with transaction(self.path, synchronous="NORMAL") as conn:
+            row = conn.execute(
+                "SELECT requests_per_minute, tokens_per_minute, request_level, token_level, updated "
+                "FROM rate_limits WHERE key = ?", (key,)
+            ).fetchone()
+            if row:
+                requests_per_minute, tokens_per_minute, request_level, token_level, updated = row
+                request_bucket = TokenBucket(requests_per_minute, request_level, updated)
+                token_bucket = TokenBucket(tokens_per_minute, token_level, updated)
+            else:
+                request_bucket = TokenBucket(self.requests_per_minute)
+                token_bucket = TokenBucket(self.tokens_per_minute)
+            now = time.time()
+            wait = max(request_bucket.wait_time(1, now), token_bucket.wait_time(tokens, now))
+            if wait <= 0:
+                request_bucket.take(1)
+                token_bucket.take(tokens)
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?, ?, ?, ?)",
+                (key, request_bucket.capacity, token_bucket.capacity, request_bucket.level, token_bucket.level, now)
+            )
+        return wait
+
+    def acquire(self, api_key: str, tokens: int = 0):
+        "Block until one request and the given number of tokens are available."
+        key = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()
+        while True:
+            try:
+                self._setup()
+                wait = self._try_acquire(key, tokens)
+            except (OSError, sqlite3.Error) as e:
+                error_logger.exception(f"Rate limiter unavailable: {e}")
+                return
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def update_limits(self, api_key: str, headers: Mapping[str, str]):
+        """
+        Set a key's limits from the x-ratelimit-limit-requests and
+        x-ratelimit-limit-tokens headers of a response, keeping RATE_LIMIT_HEADROOM
+        in reserve. Missing or unchanged limits are left alone.
+        """
+        try:
+            requests_per_minute = int(headers["x-ratelimit-limit-requests"]) * RATE_LIMIT_HEADROOM
+            tokens_per_minute = int(headers["x-ratelimit-limit-tokens"]) * RATE_LIMIT_HEADROOM
+        except (KeyError, ValueError):
+            return
+        key = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()
+        limits = (requests_per_minute, tokens_per_minute)
+        if self._known_limits.get(key) == limits:
+            return
+        try:
+            self._setup()
+            with transaction(self.path, synchronous="NORMAL") as conn:
+                conn.execute(
+                    "UPDATE rate_limits SET requests_per_minute = ?, tokens_per_minute = ?, "
+                    "request_level = MIN(request_level, ?), token_level = MIN(token_level, ?) WHERE key = ?",
+                    (requests_per_minute, tokens_per_minute, requests_per_minute, tokens_per_minute, key)
+                )
+        except (OSError, sqlite3.Error) as e:
+            error_logger.exception(f"Could not update rate limits: {e}")
+            return
+        self._known_limits[key] = limits
+
+
+def estimate_tokens(messages: list, max_tokens: int = 0) -> int:
+    """
+    Estimate the tokens a chat completion request counts against the limit: the
+    prompt, tokenized with TOKENIZER, plus the completion tokens requested.
+    """
+    # Imported here so processes that never call the API do not load the tokenizer
+    from finetune.data_preparation import TOKENIZER
+
+    tokens = max_tokens
+    for message in messages:
+        tokens += MESSAGE_OVERHEAD_TOKENS
+        content = message.get("content", "")
+        if isinstance(content, str):
+            tokens += len(TOKENIZER.encode(content))
+            continue
+        for part in content:
+            if part.get("type") == "text":
+                tokens += len(TOKENIZER.encode(part.get("text", "")))
+            else:
+                tokens += IMAGE_TOKENS
+    return tokens
+
+
+rate_limiter = RateLimiter(
+    OPENAI_RPM_LIMIT * RATE_LIMIT_HEADROOM,
+    OPENAI_TPM_LIMIT * RATE_LIMIT_HEADROOM
+)
@@ -0,0 +1,130 @@
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Optional
+
+import openai
+
+error_logger = logging.getLogger("error_logger")
+
+FATAL = "fatal"
+RATE_LIMITED = "rate_limited"
+RETRYABLE = "retryable"
+
+FATAL_ERRORS = (
+    openai.BadRequestError,
+    openai.AuthenticationError,
+    openai.NotFoundError,
+    openai.PermissionDeniedError,
+    openai.UnprocessableEntityError
+)
+
+
+def get_retry_after(e: Exception) -> Optional[float]:
+    """
+    Returns the number of seconds the server asked us to wait, from the
+    retry-after-ms or retry-after headers of the error's response, if any.
+    """
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        retry_after = headers.get("retry-after")
+        if not retry_after:
+            return None
+        try:
+            return float(retry_after)
+        except ValueError:
+            retry_at = parsedate_to_datetime(retry_after)
+            return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """
+    Iterative retry policy for API calls with jittered exponential backoff.
+
+    Errors are classified as fatal (never retried), rate limited (retried after
+    the server's Retry-After when given) or retryable. Retrying stops after
+    max_attempts or once the next wait would exceed the total time budget, and
+    the last error is raised to the caller.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 6,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        total_budget: float = 300.0,
+        fatal_errors: tuple = FATAL_ERRORS
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.total_budget = total_budget
+        self.fatal_errors = fatal_errors
+
+    def classify(self, e: Exception) -> str:
+        "Classify an error as FATAL, RATE_LIMITED or RETRYABLE."
+        if isinstance(e, self.fatal_errors) or getattr(e, "status_code", None) == 401:
+            return FATAL
+        if isinstance(e, openai.RateLimitError):
+            # Quota errors share the 429 status but will not clear on their own
+            if "quota" in str(e).lower():
+                return FATAL
+            return RATE_LIMITED
+        return RETRYABLE
+
+    def backoff(self, attempt: int) -> float:
+        "Full jitter backoff: a random wait up to the capped exponential delay."
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def delay(self, e: Exception, attempt: int) -> float:
+        "Seconds to wait before the next attempt."
+        retry_after = get_retry_after(e)
+        if retry_after is not None:
+            # A little jitter keeps clients told the same time from stampeding
+            return retry_after + random.uniform(0, self.base_delay)
+        return self.backoff(attempt)
+
+    def call(
+        self,
+        func: Callable,
+        *args,
+        on_error: Optional[Callable[[Exception, int, str], None]] = None,
+        **kwargs
+    ) -> Any:
+        """
+        Calls func with the given arguments until it succeeds or the policy gives
+        up, in which case the last error is raised. on_error, if given, is called
+        with the error, the attempt number and its classification after every
+        failure.
+        """
+        start = time.monotonic()
+        for attempt in range(self.max_attempts):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                kind = self.classify(e)
+                if on_error:
+                    on_error(e, attempt, kind)
+                if kind == FATAL or attempt + 1 >= self.max_attempts:
+                    raise
+                wait = self.delay(e, attempt)
+                if time.monotonic() - start + wait > self.total_budget:
+                    error_logger.error(f"Retry budget of {self.total_budget}s exhausted: {e}")
+                    raise
+                time.sleep(wait)
+
+
+def log_attempt(e: Exception, attempt: int, kind: str):
+    "Default on_error callback logging each failed attempt."
+    error_code = getattr(e, "status_code", None)
+    error_logger.error(f"Attempt {attempt + 1} failed ({kind}): {e}. Error code: {error_code}")
+
+
+retry_policy = RetryPolicy()
@@ -1,4 +1,269 @@
+import os
+import tempfile
 import threading
+import time
+from collections import OrderedDict, deque
+from typing import List, Optional
+
+from finetune.sqlite_db import enable_wal, transaction
+
+# "sqlite" shares statuses between every worker process on the host, as the job
+# queue is shared. "memory" keeps them in this process and only suits a single
+# worker process, since any worker may update the status of any queued job.
+STATUS_BACKEND = os.environ.get("STATUS_BACKEND", "sqlite")
+STATUS_DB_PATH = os.environ.get(
+    "STATUS_DB_PATH", os.path.join(tempfile.gettempdir(), "finetune_status.sqlite3")
+)
+STATUS_POLL_SECONDS = 0.5
+MAX_STATUS_EVENTS = int(os.environ.get("MAX_STATUS_EVENTS", 200))
+FINISHED_STATUS_TTL = int(os.environ.get("FINISHED_STATUS_TTL", 6 * 60 * 60))
+ERROR_IMAGE = '<img src="/static/icons/alert-light.png" alt="error icon" id="endError">'
 
 thread_local_storage = threading.local()
-training_status = {}
\ No newline at end of file
+
+
+class JobStatus:
+    "The recent status events of one job."
+
+    def __init__(self, max_events: int):
+        self.events = deque(maxlen=max_events)
+        self.next_seq = 1
+        self.finished_at = None
+
+
+class StatusBackend:
+    """
+    Keeps a bounded, append-only list of structured status events for each job.
+
+    Each event is a dict with a sequence number, a timestamp, a kind ("info" or
+    "error") and a message. Only the newest max_events are kept per job, and
+    finished jobs are evicted ttl seconds after they finish. HTML is rendered
+    only when the status is read.
+
+    Backends implement start, add, finish, is_finished and events. The default
+    wait_for_events polls; backends that can be notified override it.
+    """
+
+    def wait_for_events(self, job_id: str, after: int, timeout: float) -> Optional[List[dict]]:
+        """
+        Wait up to timeout seconds for a job to have events with a sequence number
+        above after, or to finish. Returns the new events, which may be empty, or
+        None if the job is still unknown.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            events = self.events(job_id, after)
+            if events or (events is not None and self.is_finished(job_id)):
+                return events
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return events
+            time.sleep(min(STATUS_POLL_SECONDS, remaining))
+
+    def render(self, job_id: str) -> Optional[str]:
+        "Render a job's status as HTML, or None if the job is unknown."
+        events = self.events(job_id)
+        if events is None:
+            return None
+        return "".join(render_event(event) for event in events)
+
+
+class StatusStore(StatusBackend):
+    "Status backend keeping events in this process's memory."
+
+    def __init__(self, max_events: int = MAX_STATUS_EVENTS, ttl: int = FINISHED_STATUS_TTL):
+        self.max_events = max_events
+        self.ttl = ttl
+        self._jobs = {}
+        self._finished = OrderedDict()
+        self._lock = threading.Lock()
+        self._updated = threading.Condition(self._lock)
+
+    def _evict_expired(self, now: float):
+        "Drop finished jobs past their TTL, oldest first."
+        while self._finished:
+            job_id, finished_at = next(iter(self._finished.items()))
+            if now - finished_at < self.ttl:
+                break
+            del self._finished[job_id]
+            self._jobs.pop(job_id, None)
+
+    def start(self, job_id: str, message: str):
+        """
+        Start a fresh status for a job with its first message. Sequence numbers
+        carry on from any earlier status, so stream cursors stay valid.
+        """
+        with self._lock:
+            self._evict_expired(time.time())
+            self._finished.pop(job_id, None)
+            previous = self._jobs.get(job_id)
+            self._jobs[job_id] = JobStatus(self.max_events)
+            if previous is not None:
+                self._jobs[job_id].next_seq = previous.next_seq
+        self.add(job_id, message)
+
+    def add(self, job_id: str, message: str, kind: str = "info") -> int:
+        "Append an event to a job's status and return its sequence number."
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                job = self._jobs[job_id] = JobStatus(self.max_events)
+            seq = job.next_seq
+            job.next_seq += 1
+            job.events.append({"seq": seq, "time": time.time(), "kind": kind, "message": message})
+            self._updated.notify_all()
+            return seq
+
+    def finish(self, job_id: str):
+        "Mark a job finished, starting its TTL."
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.finished_at is not None:
+                return
+            job.finished_at = time.time()
+            self._finished[job_id] = job.finished_at
+            self._updated.notify_all()
+
+    def is_finished(self, job_id: str) -> bool:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job is not None and job.finished_at is not None
+
+    def events(self, job_id: str, after: int = 0) -> Optional[List[dict]]:
+        "Return a job's events with a sequence number above after, or None if unknown."
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return [event for event in job.events if event["seq"] > after]
+
+    def wait_for_events(self, job_id: str, after: int, timeout: float) -> Optional[List[dict]]:
+        "Wait for new events, woken as soon as they are added."
+        deadline = time.monotonic() + timeout
+        with self._updated:
+            while True:
+                job = self._jobs.get(job_id)
+                if job is not None and (
+                    (job.events and job.events[-1]["seq"] > after) or job.finished_at is not None
+                ):
+                    return [event for event in job.events if event["seq"] > after]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None if job is None else []
+                self._updated.wait(remaining)
+
+
+class SQLiteStatusStore(StatusBackend):
+    """
+    Status backend keeping events in a SQLite database in WAL mode, so every
+    worker process on the host reads and writes the same statuses.
+    """
+
+    def __init__(self, path: str = STATUS_DB_PATH, max_events: int = MAX_STATUS_EVENTS, ttl: int = FINISHED_STATUS_TTL):
+        self.path = path
+        self.max_events = max_events
+        self.ttl = ttl
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        enable_wal(path)
+        with transaction(self.path, synchronous="NORMAL") as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS status_jobs ("
+                "job_id TEXT PRIMARY KEY, next_seq INTEGER NOT NULL, finished_at REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS status_events ("
+                "job_id TEXT NOT NULL, seq INTEGER NOT NULL, time REAL NOT NULL, "
+                "kind TEXT NOT NULL, message TEXT NOT NULL, PRIMARY KEY (job_id, seq))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS status_jobs_finished ON status_jobs (finished_at)")
+
+    def start(self, job_id: str, message: str):
+        "Start a fresh status for a job, keeping its sequence numbers increasing."
+        with transaction(self.path, synchronous="NORMAL") as conn:
+            expired = time.time() - self.ttl
+            conn.execute(
+                "DELETE FROM status_events WHERE job_id IN "
+                "(SELECT job_id FROM status_jobs WHERE finished_at < ?)", (expired,)
+            )
+            conn.execute("DELETE FROM status_jobs WHERE finished_at < ?", (expired,))
+            conn.execute("DELETE FROM status_events WHERE job_id = ?", (job_id,))
+            conn.execute(
+                "INSERT INTO status_jobs (job_id, next_seq) VALUES (?, 1) "
+                "ON CONFLICT (job_id) DO UPDATE SET finished_at = NULL", (job_id,)
+            )
+        self.add(job_id, message)
+
+    def add(self, job_id: str, message: str, kind: str = "info") -> int:
+        "Append an event to a job's status and return its sequence number."
+        with transaction(self.path, synchronous="NORMAL") as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO status_jobs (job_id, next_seq) VALUES (?, 1)", (job_id,)
+            )
+            seq = conn.execute(
+                "SELECT next_seq FROM status_jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()[0]
+            conn.execute(
+                "INSERT INTO status_events (job_id, seq, time, kind, message) VALUES (?, ?, ?, ?, ?)",
+                (job_id, seq, time.time(), kind, message)
+            )
+            conn.execute("UPDATE status_jobs SET next_seq = ? WHERE job_id = ?", (seq + 1, job_id))
+            conn.execute(
+                "DELETE FROM status_events WHERE job_id = ? AND seq <= ?",
+                (job_id, seq - self.max_events)
+            )
+        return seq
+
+    def finish(self, job_id: str):
+        "Mark a job finished, starting its TTL."
+        with transaction(self.path, synchronous="NORMAL") as conn:
+            conn.execute(
+                "UPDATE status_jobs SET finished_at = ? WHERE job_id = ? AND finished_at IS NULL",
+                (time.time(), job_id)
+            )
+
+    def is_finished(self, job_id: str) -> bool:
+        with transaction(self.path, write=False) as conn:
+            row = conn.execute(
+                "SELECT finished_at FROM status_jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        return row is not None and row[0] is not None
+
+    def events(self, job_id: str, after: int = 0) -> Optional[List[dict]]:
+        "Return a job's events with a sequence number above after, or None if unknown."
+        with transaction(self.path, write=False) as conn:
+            if not conn.execute("SELECT 1 FROM status_jobs WHERE job_id = ?", (job_id,)).fetchone():
+                return None
+            rows = conn.execute(
+                "SELECT seq, time, kind, message FROM status_events "
+                "WHERE job_id = ? AND seq > ? ORDER BY seq", (job_id, after)
+            ).fetchall()
+        return [{"seq": seq, "time": at, "kind": kind, "message": message} for seq, at, kind, message in rows]
+
+
+def create_status_store() -> StatusBackend:
+    "Create the status backend selected by STATUS_BACKEND."
+    if STATUS_BACKEND == "sqlite":
+        return SQLiteStatusStore()
+    return StatusStore()
+
+
+def render_event(event: dict) -> str:
+    "Render a single status event as HTML."
+    if event["kind"] == "error":
+        return f"<p>{ERROR_IMAGE} {event['message']}</p>"
+    return f"<p>{event['message']}</p>"
+
+_training_status_lock = threading.Lock()
+
+def __getattr__(name: str):
+    """
+    Creates training_status on first import, rather than when this module is
+    loaded, so processes that only need thread_local_storage, such as the PDF
+    pool's, do not open the status database.
+    """
+    if name != "training_status":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _training_status_lock:
+        if "training_status" not in globals():
+            globals()["training_status"] = create_status_store()
+    return globals()["training_status"]
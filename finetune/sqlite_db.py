@@ -0,0 +1,40 @@
+import sqlite3
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+
+def enable_wal(path: str):
+    """
+    Switch a SQLite database to write-ahead logging, so readers in other
+    processes are not blocked by writers. The mode is stored in the database
+    file and cannot be changed inside a transaction.
+    """
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+    finally:
+        conn.close()
+
+@contextmanager
+def transaction(path: str, write: bool = True, synchronous: Optional[str] = None) -> Iterator[sqlite3.Connection]:
+    """
+    Open a connection to a SQLite database for a single transaction, committing
+    on success and rolling back on any error. Write transactions take the write
+    lock up front with BEGIN IMMEDIATE, so two writers never deadlock upgrading
+    their locks; read-only ones are deferred, so under WAL they neither wait for
+    nor block writers. synchronous, such as "NORMAL", sets the connection's
+    PRAGMA synchronous.
+    """
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    try:
+        if synchronous:
+            conn.execute(f"PRAGMA synchronous={synchronous}")
+        conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        yield conn
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
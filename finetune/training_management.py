@@ -1,19 +1,42 @@
 import os
+import shutil
 import time
+from array import array
+from concurrent.futures import as_completed
+from concurrent.futures.process import BrokenProcessPool
 from datetime import timedelta
+from typing import Optional
 
 import openai
 
+import metrics
 from file_handling import read_text_file, write_jsonl_file
+from metrics import CHUNKING_SECONDS, STAGE_SECONDS, TimedIterator
+from process_pool import SpawnPool
+from profiling import profiled
 from send_email import email_admin
 from set_folders import FileStorageHandler
-from finetune.chunking import split_into_chunks
+from finetune.api_management import ReportedError
+from finetune.checkpoints import Checkpoint
+from finetune.chunking import split_into_chunks, BEATS_CONCURRENCY
+from finetune.dataset_analysis import analyze_dataset, tally_tokens, write_token_counts
 from finetune.openai_client import get_client, set_client
+from finetune.rate_limiter import rate_limiter
+from finetune.retry import log_attempt, retry_policy
 from finetune.shared_resources import training_status, thread_local_storage
+from finetune.usage import summarize_usage, usage_tracker
 
 
 folders = FileStorageHandler()
 download_folder = folders.download_folder
+
+# Number of processes used to read and chunk uploaded files. Set to 0 to chunk
+# files one after another in the job's own thread. Each gunicorn worker has its
+# own pool, and each process holds a whole book and its chunks in memory.
+FILE_WORKERS = int(os.environ.get("FILE_WORKERS", min(2, os.cpu_count() or 1)))
+FINETUNE_MODEL = "gpt-3.5-turbo-1106"
+file_pool = SpawnPool(FILE_WORKERS)
+
 def generate_url(gcs_file: str) -> str:
     """
     Generate's signed url from Google Cloud Storage for user to download JSONL file.
@@ -28,121 +51,212 @@ def generate_url(gcs_file: str) -> str:
     return blob.generate_signed_url(expiration=timedelta(hours=2), method='GET')
 
 
-def psuedo_animation(user_folder: str, message: str):
-    """Simulate a animation by updating the training status with a message and
-        a cyclically changing number dots."""
-    
-    original_message = training_status[user_folder]
-    for i in range(1, 4):
-        training_status[user_folder] = f"{original_message}<p>{message}{'.' * i}</p>"
-        time.sleep(5)
-
-def fine_tune(folder_name: str, user_folder: str, retry_count: int=0):
+def fine_tune(folder_name: str, user_folder: str, checkpoint: Checkpoint) -> Optional[str]:
     """
     Fine-tunes a language model using the specified data.
 
-    This function uploads the JSONL fine-tuning data file, monitors its processing,
-    and initiates fine-tuning on the specified model. It updates the training status
-    as the fine-tuning process progresses.
+    This function uploads the JSONL fine-tuning data file and initiates fine-tuning
+    on the specified model. The caller hands the returned job to the shared job
+    monitor, which updates the training status as the fine-tuning process
+    progresses. Every API
+    call goes through the shared rate limiter and retry policy. The uploaded file
+    id and the fine-tuning job id are checkpointed, so a resumed job neither
+    uploads the file again nor starts a second fine-tuning job.
 
     Args:
         folder_name (str): The name of the folder containing the fine-tuning data file.
+        checkpoint (Checkpoint): The job's checkpoint.
 
     Returns:
-        None
+        str: The id of the fine-tuning job, or None if it could not be started.
     """
-    if retry_count:
-        time.sleep(retry_count**retry_count)
 
     client = get_client()
     fine_tune_file = os.path.join(folder_name, "fine_tune.jsonl")
 
+    def request(endpoint, func, *args, **kwargs):
+        """
+        Call the API under the rate limiter, retrying according to the retry
+        policy, and record the call's latency and retries.
+        """
+        attempts = 0
+        def attempt():
+            nonlocal attempts
+            attempts += 1
+            rate_limiter.acquire(client.api_key)
+            return func(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return retry_policy.call(attempt, on_error=log_attempt)
+        finally:
+            usage_tracker.record(
+                endpoint, FINETUNE_MODEL, None, time.perf_counter() - started,
+                max(0, attempts - 1), job_id=user_folder
+            )
+
+    def upload_file():
+        with open(fine_tune_file, "rb") as f:
+            return client.files.create(file=f, purpose="fine-tune")
+
     try:
-        JSONL_file = client.files.create(
-            file = open(fine_tune_file, "rb"),
-            purpose = "fine-tune"
-        )
-        training_status[user_folder] += "<p>Fine-tuning file uploaded</p>"
-        print(training_status[user_folder])
-        fine_tune_job = client.fine_tuning.jobs.create(training_file=JSONL_file.id, model="gpt-3.5-turbo-1106")
-        while True:
-            fine_tune_info = client.fine_tuning.jobs.retrieve(fine_tune_job.id)
-            psuedo_animation(user_folder, "Finetuning")
-            if fine_tune_info.status == "succeeded":
-                training_status[user_folder] += (
-                    f"<p>{fine_tune_info.status}</p>"
-                    f"<p>Fine-tuned model info {fine_tune_info}</p>"
-                    f"<p>Model id {fine_tune_info.id }</p>"
-                )
-                break
-            else:
-                current_event = client.fine_tuning.jobs.list_events(
-                    fine_tuning_job_id=fine_tune_job.id,
-                    limit = 1
-                )
-                if "data" in current_event and isinstance(current_event["data"], list) and len(current_event["data"]) > 0 and "message" in current_event["data"][0]:
-                    training_status[user_folder] += f"<p>{current_event['data'][0]['message']}</p>"
+        job_id = checkpoint.get("fine_tune_job_id")
+        if job_id is None:
+            file_id = checkpoint.get("training_file_id")
+            if file_id is None:
+                file_id = request("files", upload_file).id
+                checkpoint.set("training_file_id", file_id)
+            training_status.add(user_folder, "Fine-tuning file uploaded")
+            job_id = request("fine_tuning", client.fine_tuning.jobs.create, training_file=file_id, model=FINETUNE_MODEL).id
+            checkpoint.set("fine_tune_job_id", job_id)
+        training_status.add(user_folder, "Finetuning")
+        return job_id
     except openai.NotFoundError as e:
         email_admin(e)
-        return
+        return None
     except (openai.AuthenticationError, openai.BadRequestError, openai.PermissionDeniedError, openai.RateLimitError)as e:
-        training_status[user_folder] += f"<p>{e.message}</p>"
-        return
-    except (openai.APIConnectionError, openai.APITimeoutError, openai.ConflictError, openai.InternalServerError, openai.UnprocessableEntityError) as e:
-        retry_count += 1
-        if retry_count > 3:
-            training_status[user_folder] += "<p>A critical error has occured. The administrator has been contacted. Sorry for the inconvience</p>"
-            email_admin(e)
-            return
-        fine_tune(folder_name, user_folder, retry_count)
+        training_status.add(user_folder, e.message, kind="error")
+        return None
+    except Exception as e:
+        training_status.add(user_folder, "A critical error has occured. The administrator has been contacted. Sorry for the inconvience", kind="error")
+        email_admin(e)
+        return None
+
+def chunk_file(file_path: str, role: str, chunk_type: str, beats_concurrency: int = BEATS_CONCURRENCY) -> str:
+    """
+    Reads a book file, splits it into chunks and writes the formatted messages to
+    a JSONL file next to it. Runs either in the job's thread or in a process of
+    the file pool.
+
+    The number of tokens in each example is counted as it is written and saved
+    next to the JSONL file, for the dataset report. The JSONL file is written
+    under a temporary name and renamed once complete, so its existence marks the
+    book as chunked. Generated beats are checkpointed per chapter in a folder
+    next to the book.
+
+    Args:
+        file_path (str): The path to the book file.
+        role (str): The system message to be used in fine-tuning.
+        chunk_type (str): The type of chunking to be applied.
+        beats_concurrency (int): The maximum number of concurrent API calls when
+            generating beats.
 
-def process_files(folder_name: str, role: str, chunk_type: str, user_folder: str) -> str:
+    Returns:
+        str: The path to the JSONL file for the book.
+    """
+    with STAGE_SECONDS.time(stage="book_read"):
+        book = read_text_file(file_path)
+    part_path = f"{file_path}.jsonl"
+    temp_path = f"{part_path}.tmp"
+    chunks = TimedIterator(split_into_chunks(book, role, chunk_type, beats_concurrency, beats_dir=f"{file_path}.beats"))
+    counts = array("I")
+    tallied = TimedIterator(tally_tokens(chunks, counts))
+    started = time.perf_counter()
+    write_jsonl_file(tallied, temp_path)
+    write_token_counts(counts, f"{part_path}.tokens")
+    os.replace(temp_path, part_path)
+    CHUNKING_SECONDS.observe(chunks.seconds, chunk_type=chunk_type)
+    STAGE_SECONDS.observe(tallied.seconds - chunks.seconds, stage="dataset_analysis")
+    STAGE_SECONDS.observe(time.perf_counter() - started - tallied.seconds, stage="jsonl_write")
+    return part_path
+
+def chunk_file_in_pool(file_path: str, role: str, chunk_type: str) -> tuple:
+    """
+    Runs chunk_file in a process of the file pool, returning the path to the
+    JSONL file along with the metrics observed, for the job's process to record.
+    """
+    with metrics.capture() as observations:
+        part_path = chunk_file(file_path, role, chunk_type)
+    return part_path, observations
+
+def book_files(folder_name: str) -> list:
+    "The paths of the books in a job folder, in the order they are merged."
+    txt_files = sorted(file for file in os.listdir(folder_name) if file.endswith(".txt"))
+    return [os.path.join(folder_name, file_name) for file_name in txt_files]
+
+def process_files(folder_name: str, role: str, chunk_type: str, user_folder: str, beats_concurrency: int = BEATS_CONCURRENCY, in_thread: bool = False) -> str:
     """
     Process book files into formatted messages for fine-tuning.
 
-    This function iterates through the text files in the specified folder, reads
-    their content, splits them into chunks based on the specified system role and
-    chunk type, and collects the formatted messages for fine-tuning. It updates
-    the training status as files are processed.
+    This function chunks each text file in the specified folder into its own JSONL
+    file, then merges them in file name order into the fine-tuning file. Unless
+    FILE_WORKERS is 0, files are chunked in parallel in the shared process pool;
+    generate_beats jobs always run in the job's thread, since they wait on the API
+    rather than the CPU, and so do profiled jobs, so the profile covers the
+    chunkers. Files already chunked by an earlier run of the job are skipped. It
+    updates the training status as files are processed.
 
     Args:
         folder_name (str): The name of the folder containing book files.
         role (str): The system message to be used in fine-tuning.
         chunk_type (str): The type of chunking to be applied.
+        beats_concurrency (int): The maximum number of concurrent API calls when
+            generating beats.
+        in_thread (bool): Chunk files in the job's thread even if the file pool
+            is enabled.
 
     Returns:
         str: The path to the generated JSONL file containing fine-tuning messages.
     """
 
-    fine_tune_messages = []
-    txt_files = [file for file in os.listdir(folder_name) if file.endswith("txt")]
-    total_files = len(txt_files)
-
-    starting_message = training_status[user_folder]
-    for i, file_name in enumerate(os.listdir(folder_name), start=1):
-        if file_name.endswith("txt"):
-            file_path = os.path.join(folder_name, file_name)
-            book = read_text_file(file_path)
-            formatted_messages = split_into_chunks(book, role, chunk_type)
-            fine_tune_messages.extend(formatted_messages)
-            training_status[user_folder] = f"{starting_message}<p>File {i} of {total_files} processed</p>"
-    training_status[user_folder] += "<p>All files processed</p>"
+    file_paths = book_files(folder_name)
+    total_files = len(file_paths)
+    pending = [file_path for file_path in file_paths if not os.path.exists(f"{file_path}.jsonl")]
+    done = total_files - len(pending)
+    if done:
+        training_status.add(user_folder, f"{done} of {total_files} files already processed")
+
+    if FILE_WORKERS > 0 and chunk_type != "generate_beats" and not in_thread:
+        pool = file_pool.get()
+        futures = []
+        try:
+            futures = [pool.submit(chunk_file_in_pool, file_path, role, chunk_type) for file_path in pending]
+            for i, future in enumerate(as_completed(futures), start=done + 1):
+                _, observations = future.result()
+                metrics.replay(observations)
+                training_status.add(user_folder, f"File {i} of {total_files} processed")
+        except BrokenProcessPool:
+            file_pool.discard(pool)
+            raise
+        finally:
+            for future in futures:
+                future.cancel()
+    else:
+        for i, file_path in enumerate(pending, start=done + 1):
+            chunk_file(file_path, role, chunk_type, beats_concurrency)
+            training_status.add(user_folder, f"File {i} of {total_files} processed")
+
     fine_tune_path = os.path.join(folder_name, "fine_tune.jsonl")
-    write_jsonl_file(fine_tune_messages, fine_tune_path)
-    training_status[user_folder] += "<p>Preparing JSONL file for download</p>"
+    with open(fine_tune_path, "wb") as fine_tune_file:
+        for file_path in file_paths:
+            part_path = f"{file_path}.jsonl"
+            with open(part_path, "rb") as part_file:
+                shutil.copyfileobj(part_file, fine_tune_file)
+    training_status.add(user_folder, "All files processed")
+    training_status.add(user_folder, "Preparing JSONL file for download")
     gcs_file = f"{user_folder}_fine_tune.jsonl"
-    folders.upload_file_to_gcs(fine_tune_path, gcs_file)
+    with STAGE_SECONDS.time(stage="gcs_upload"):
+        folders.upload_file_to_gcs(fine_tune_path, gcs_file)
 
     return gcs_file
 
-def train(folder_name: str, role: str, user_key: str, chunk_type: str, user_folder: str):
+def train(folder_name: str, role: str, user_key: str, chunk_type: str, user_folder: str, beats_concurrency: int = BEATS_CONCURRENCY, profile: bool = False) -> Optional[str]:
     """
     Sets up the process for processing book files into training data and finetuning
     a LLM. This function sets up the necessary OpenAI client using the user's API key,
-    initializes a the training_status dictionary if it hasn't been intialized, processes
-    files in the specified folder, and performs fine-tuning.
+    starts a fresh training status for the job, processes files in the specified
+    folder, and performs fine-tuning. The status is marked finished here unless a
+    fine-tuning job was started, which the caller hands to the job monitor.
     After training is complete, a download link to the JSONL file is provided.
 
+    Each completed stage is checkpointed in the job folder, so running the job
+    again, for instance after the job queue recovers it from a restart, resumes
+    from the last completed stage.
+
+    Profiled jobs save a cProfile of the run to the job folder and the bucket.
+
+    Before anything is sent to OpenAI, the dataset's token counts and estimated
+    training cost are reported, and datasets OpenAI would reject are stopped.
+
     Note: This function deletes the user_key after use for security reasons.
 
     Args:
@@ -150,16 +264,49 @@ def train(folder_name: str, role: str, user_key: str, chunk_type: str, user_fold
         role (str): The system message to be used in fine tuning.
         user_key (str): The user's API key.
         chunk_type (str): The type chunking to be used.
+        beats_concurrency (int): The maximum number of concurrent API calls when
+            generating beats for this job.
+        profile (bool): Whether to profile the job.
 
     Returns:
-        None
+        str: The id of the fine-tuning job to monitor, or None if the job failed.
     """
 
-    training_status[user_folder] = "<p>Processing files</p>"
+    training_status.start(user_folder, "Processing files")
     set_client(user_key)
     del user_key
     thread_local_storage.user_folder = user_folder
-    gcs_file = process_files(folder_name, role, chunk_type, user_folder)
-    download_path = generate_url(gcs_file)
-    training_status[user_folder] += f"<p>Download <a href='{download_path}'>JSONL file here</a>.</p>"
-    fine_tune(folder_name, user_folder)
+    fine_tune_job_id = None
+    try:
+        with profiled(folder_name, "train", profile):
+            checkpoint = Checkpoint(folder_name)
+            gcs_file = checkpoint.get("gcs_file")
+            if gcs_file is None:
+                gcs_file = process_files(folder_name, role, chunk_type, user_folder, beats_concurrency, in_thread=profile)
+                checkpoint.set("gcs_file", gcs_file)
+            download_path = generate_url(gcs_file)
+            training_status.add(user_folder, f"Download <a href='{download_path}'>JSONL file here</a>.")
+            if checkpoint.get("training_file_id") is None:
+                with STAGE_SECONDS.time(stage="dataset_report"):
+                    report = analyze_dataset(f"{file_path}.jsonl" for file_path in book_files(folder_name))
+                training_status.add(user_folder, report.summary())
+                if report.errors:
+                    for error in report.errors:
+                        training_status.add(user_folder, error, kind="error")
+                    return None
+            fine_tune_job_id = fine_tune(folder_name, user_folder, checkpoint)
+            return fine_tune_job_id
+    except Exception as e:
+        # Beats errors have already been reported by error_handle
+        if not isinstance(e, ReportedError):
+            training_status.add(user_folder, "A critical error has occured. The administrator has been contacted. Sorry for the inconvience", kind="error")
+            email_admin(e)
+        raise
+    finally:
+        totals = usage_tracker.pop_job(user_folder)
+        if totals:
+            training_status.add(user_folder, summarize_usage(totals))
+        if fine_tune_job_id is None:
+            training_status.finish(user_folder)
+        set_client(None)
+        thread_local_storage.user_folder = None
@@ -0,0 +1,72 @@
+import threading
+from typing import Any, Dict, Optional
+
+from metrics import OPENAI_RETRIES, OPENAI_TOKENS
+
+
+class Usage:
+    "Running totals of OpenAI calls."
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.seconds = 0.0
+        self.retries = 0
+
+    def add(self, prompt_tokens: int, completion_tokens: int, seconds: float, retries: int):
+        self.calls += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.seconds += seconds
+        self.retries += retries
+
+
+class UsageTracker:
+    """
+    Records the tokens, latency, model and retries of every OpenAI call. Totals
+    are kept per job and endpoint until the job ends, and every call feeds the
+    token and retry counters served at /metrics.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint: str, model: str, usage: Any, seconds: float, retries: int = 0, job_id: Optional[str] = None):
+        """
+        Record one call. usage is the usage block of the API response, or None
+        for endpoints that do not report one.
+        """
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        OPENAI_TOKENS.inc(prompt_tokens, endpoint=endpoint, model=model, kind="prompt")
+        OPENAI_TOKENS.inc(completion_tokens, endpoint=endpoint, model=model, kind="completion")
+        OPENAI_RETRIES.inc(retries, endpoint=endpoint)
+        if job_id is None:
+            return
+        with self._lock:
+            totals = self._jobs.setdefault(job_id, {})
+            totals.setdefault(endpoint, Usage()).add(prompt_tokens, completion_tokens, seconds, retries)
+
+    def pop_job(self, job_id: str) -> Dict[str, Usage]:
+        "Return a job's totals by endpoint and stop tracking it."
+        with self._lock:
+            return self._jobs.pop(job_id, {})
+
+
+def summarize_usage(totals: Dict[str, Usage]) -> str:
+    "Describe a job's totals by endpoint in one line for its training status."
+    parts = []
+    for endpoint, usage in sorted(totals.items()):
+        part = f"{endpoint}: {usage.calls} calls"
+        if usage.prompt_tokens or usage.completion_tokens:
+            part += f", {usage.prompt_tokens:,} prompt tokens, {usage.completion_tokens:,} completion tokens"
+        part += f", {usage.seconds:.1f}s"
+        if usage.retries:
+            part += f", {usage.retries} retries"
+        parts.append(part)
+    return "API usage: " + "; ".join(parts)
+
+
+usage_tracker = UsageTracker()
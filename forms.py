@@ -1,7 +1,7 @@
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileAllowed, FileField
-from wtforms import    BooleanField, SelectField, StringField, SubmitField, TextAreaField
-from wtforms.validators import DataRequired, Email, Length, Regexp
+from wtforms import    BooleanField, IntegerField, SelectField, StringField, SubmitField, TextAreaField
+from wtforms.validators import DataRequired, Email, Length, NumberRange, Optional, Regexp
 
 class ContactForm(FlaskForm):
     name = StringField('Your Name', validators=[DataRequired()])
@@ -37,6 +37,10 @@ class FineTuneForm(FlaskForm):
         ('dialogue_prose', 'Dialogue/Prose'),
         ('generate_beats', 'Generate Beats (extra cost)')
     ], validators=[DataRequired()])
+    beats_concurrency = IntegerField('Concurrent beats requests', validators=[
+        Optional(),
+        NumberRange(min=1, max=16, message="Must be between 1 and 16")
+    ])
     rights_confirmation = BooleanField('I confirm that I have the rights to these files', validators=[DataRequired()])
     terms_agreement = BooleanField('I agree to the ', validators=[DataRequired()])
     submit = SubmitField('Finetune GPT-3.5')
\ No newline at end of file
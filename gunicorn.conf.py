@@ -0,0 +1,12 @@
+import os
+
+# gunicorn reads this file from the working directory on start.
+# Status streams stay open while a job runs, so each worker serves requests from
+# a pool of threads; a sync worker would be tied up by one stream and killed by
+# the worker timeout, taking its job queue threads with it.
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+worker_class = "gthread"
+workers = int(os.environ.get("GUNICORN_WORKERS", 2))
+# Each open /status/stream holds a thread for up to STREAM_MAX_SECONDS
+threads = int(os.environ.get("GUNICORN_THREADS", 32))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
@@ -0,0 +1,247 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+# Bucket upper bounds in seconds, from fast local stages up to fine-tuning jobs
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300,
+    600, 1800, 3600, 7200, 14400
+)
+
+_registry = {}
+_registry_lock = threading.Lock()
+_capture = threading.local()
+
+
+def _format_labels(labels: Iterable[Tuple[str, str]]) -> str:
+    "Format label pairs as they appear in the exposition format."
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    A named metric with an optional set of labels, registered for the /metrics
+    endpoint when created. Label values are passed as keyword arguments.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry[name] = self
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _record(self, method: str, value: float, labels: dict) -> bool:
+        """
+        Hands the observation to an active capture instead of recording it here.
+        Returns True if it was captured.
+        """
+        captured = getattr(_capture, "observations", None)
+        if captured is None:
+            return False
+        captured.append((self.name, method, value, labels))
+        return True
+
+    def samples(self) -> List[Tuple[str, tuple, float]]:
+        "Returns (suffix, label pairs, value) for every sample of the metric."
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    "A value that only goes up, such as a number of requests."
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        if self._record("inc", amount, labels):
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[Tuple[str, tuple, float]]:
+        with self._lock:
+            return [
+                ("_total", tuple(zip(self.labelnames, key)), value)
+                for key, value in sorted(self._values.items())
+            ]
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. A gauge given a function reads its value from
+    it on every scrape instead of being set.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), function: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value: float, **labels):
+        if self._record("set", value, labels):
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self) -> List[Tuple[str, tuple, float]]:
+        if self.function is not None:
+            try:
+                return [("", (), self.function())]
+            except Exception:
+                # A gauge that cannot be read is left out rather than failing the scrape
+                return []
+        with self._lock:
+            return [
+                ("", tuple(zip(self.labelnames, key)), value)
+                for key, value in sorted(self._values.items())
+            ]
+
+
+class Histogram(Metric):
+    "Counts observations, such as durations in seconds, into cumulative buckets."
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        if self._record("observe", value, labels):
+            return
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        "Observe how long the block takes."
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> List[Tuple[str, tuple, float]]:
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                labels = tuple(zip(self.labelnames, key))
+                for bound, count in zip(self.buckets, counts):
+                    samples.append(("_bucket", labels + (("le", _format_value(bound)),), count))
+                samples.append(("_sum", labels, total))
+                samples.append(("_count", labels, counts[-1]))
+        return samples
+
+
+class TimedIterator:
+    """
+    Wraps an iterator, adding up the time spent producing its items, so a
+    streaming stage can be timed apart from the stage consuming it.
+    """
+
+    def __init__(self, iterable: Iterable):
+        self._iterator = iter(iterable)
+        self.seconds = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            return next(self._iterator)
+        finally:
+            self.seconds += time.perf_counter() - started
+
+
+@contextmanager
+def capture() -> Iterator[list]:
+    """
+    Collects the observations made by this thread instead of recording them, so
+    work done in another process can return them to be replayed where the
+    metrics are served.
+    """
+    previous = getattr(_capture, "observations", None)
+    _capture.observations = []
+    try:
+        yield _capture.observations
+    finally:
+        _capture.observations = previous
+
+def replay(observations: list):
+    "Record observations collected by capture."
+    for name, method, value, labels in observations:
+        metric = _registry.get(name)
+        if metric is not None:
+            getattr(metric, method)(value, **labels)
+
+def render_metrics() -> str:
+    "Render every registered metric in the Prometheus text exposition format."
+    with _registry_lock:
+        metrics = list(_registry.values())
+    return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "prosepal_stage_seconds", "Time spent in each stage of handling uploads and jobs.", ("stage",)
+)
+CHUNKING_SECONDS = Histogram(
+    "prosepal_chunking_seconds", "Time spent splitting one book into chunks, by chunk type.", ("chunk_type",)
+)
+CONVERSION_SECONDS = Histogram(
+    "prosepal_conversion_seconds", "Time spent converting one ebook to text, by format.", ("format",)
+)
+JOB_QUEUE_SECONDS = Histogram(
+    "prosepal_job_queue_seconds", "Time fine-tuning jobs waited in the job queue."
+)
+JOB_RUN_SECONDS = Histogram(
+    "prosepal_job_run_seconds", "Time from a job leaving the queue to its fine-tuning job being started, or the job failing."
+)
+FINETUNE_SECONDS = Histogram(
+    "prosepal_finetune_seconds", "Time OpenAI fine-tuning jobs took, by final status.", ("status",)
+)
+OPENAI_REQUEST_SECONDS = Histogram(
+    "prosepal_openai_request_seconds", "Latency of OpenAI API calls, including retries, by endpoint.", ("endpoint",)
+)
+OPENAI_REQUESTS = Counter(
+    "prosepal_openai_requests", "OpenAI API calls by endpoint and outcome.", ("endpoint", "outcome")
+)
+OPENAI_TOKENS = Counter(
+    "prosepal_openai_tokens", "Tokens used by OpenAI API calls by endpoint, model and kind.", ("endpoint", "model", "kind")
+)
+OPENAI_RETRIES = Counter(
+    "prosepal_openai_retries", "Retried attempts of OpenAI API calls by endpoint.", ("endpoint",)
+)
@@ -0,0 +1,36 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+
+class SpawnPool:
+    """
+    A process pool shared by every job in this worker, created on first use.
+    Processes are spawned rather than forked so they do not inherit the state of
+    the web server's threads. A process that dies, for instance when it runs out
+    of memory, breaks a pool for good, so a broken pool is discarded and the next
+    get() creates a new one.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max(1, max_workers)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> ProcessPoolExecutor:
+        "Returns the pool, creating it if needed."
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._pool
+
+    def discard(self, pool: ProcessPoolExecutor):
+        "Drops a broken pool returned by get(), unless it was already replaced."
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
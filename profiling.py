@@ -0,0 +1,86 @@
+import cProfile
+import hmac
+import io
+import logging
+import os
+import pstats
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from set_folders import FileStorageHandler
+
+folders = FileStorageHandler()
+error_logger = logging.getLogger("error_logger")
+info_logger = logging.getLogger("info_logger")
+
+# Profile every job when set, or only jobs requested with PROFILE_ADMIN_TOKEN
+PROFILE_JOBS = os.environ.get("PROFILE_JOBS", "").lower() in ("1", "true", "yes")
+PROFILE_ADMIN_TOKEN = os.environ.get("PROFILE_ADMIN_TOKEN")
+PROFILE_SUMMARY_LINES = 60
+
+
+def profiling_requested(token: Optional[str]) -> bool:
+    """
+    Whether a job should be profiled: either PROFILE_JOBS is set, or the request
+    carries the admin token.
+    """
+    if PROFILE_JOBS:
+        return True
+    if not (PROFILE_ADMIN_TOKEN and token):
+        return False
+    return hmac.compare_digest(token.encode("utf-8"), PROFILE_ADMIN_TOKEN.encode("utf-8"))
+
+def save_profile(profiler: cProfile.Profile, folder_name: str, name: str):
+    """
+    Writes a profile to profiles/<name>.pstats in the job folder, along with a
+    text summary of the most expensive calls, and uploads both to the bucket
+    under profiles/. The .pstats file loads in pstats, snakeviz or flameprof.
+    The profiles are kept out of the job folder itself, where every .txt file
+    is a book.
+    """
+    profile_folder = os.path.join(folder_name, "profiles")
+    os.makedirs(profile_folder, exist_ok=True)
+    stats_path = os.path.join(profile_folder, f"{name}.pstats")
+    summary_path = os.path.join(profile_folder, f"{name}_profile.log")
+    profiler.dump_stats(stats_path)
+
+    summary = io.StringIO()
+    stats = pstats.Stats(stats_path, stream=summary)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_SUMMARY_LINES)
+    stats.sort_stats(pstats.SortKey.TIME).print_stats(PROFILE_SUMMARY_LINES)
+    with open(summary_path, "w") as f:
+        f.write(summary.getvalue())
+
+    job = os.path.basename(os.path.normpath(folder_name))
+    for path in (stats_path, summary_path):
+        folders.upload_file_to_gcs(path, f"profiles/{job}/{os.path.basename(path)}")
+    info_logger.info(f"Saved {name} profile for {job}")
+
+@contextmanager
+def profiled(folder_name: str, name: str, enabled: bool = True) -> Iterator[Optional[cProfile.Profile]]:
+    """
+    Profiles the block with cProfile when enabled and saves the result with
+    save_profile, even if the block raises. Failing to start or save a profile
+    never fails the job; the block then runs unprofiled.
+    """
+    if not enabled:
+        yield None
+        return
+
+    try:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    except Exception as e:
+        # For instance when another profiler is already active in this thread
+        error_logger.exception(f"Could not start {name} profile: {e}")
+        yield None
+        return
+
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        try:
+            save_profile(profiler, folder_name, name)
+        except Exception as e:
+            error_logger.exception(f"Could not save {name} profile: {e}")
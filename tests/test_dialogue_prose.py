@@ -0,0 +1,109 @@
+import random
+from typing import Iterator, Tuple
+
+import pytest
+
+from finetune.chunking import dialogue_prose, extract_dialogue
+from finetune.data_preparation import separate_into_chapters
+
+PIECES = ["He", "said", "she", "ran", "away", "and", "then", "stopped", "Mr", "Dr", "...", ".", "?", "!", '"', '"', " ", " ", " ", "'", ",", "\t", "é"]
+
+
+def reference_extract_dialogue(paragraph: str) -> Tuple[str, str]:
+    "extract_dialogue as it was before scan_dialogue, character by character."
+    dialogue = ""
+    prose = ""
+    sentence = ""
+    check_next_char = False
+    end_sentence = False
+    in_dialogue = False
+    punctuation = [".", "?", "!"]
+    quote_count = 0
+
+    for i, char in enumerate(paragraph):
+        sentence += char
+        if char == '"':
+            quote_count += 1
+            in_dialogue = True if (quote_count // 2 == 1) else False
+            end_sentence = True if check_next_char is True else False
+            check_next_char = False
+        if char in punctuation:
+            if i + 1 < len(paragraph):
+                check_next_char = True
+                continue
+            end_sentence = True
+        if end_sentence is True:
+            if in_dialogue is False:
+                prose += sentence.strip()
+            elif in_dialogue is True:
+                dialogue += sentence.strip()
+            sentence = ""
+            end_sentence = False
+    return prose, dialogue
+
+def reference_dialogue_prose(book: str) -> Iterator[Tuple[str, str]]:
+    "dialogue_prose as it was before scan_dialogue, counting marks in the joined text."
+    punctuation = [".", "?", "!"]
+    for chapter in separate_into_chapters(book):
+        for paragraph in chapter.split("\n"):
+            prose, dialogue = reference_extract_dialogue(paragraph)
+            prose_sentences = sum(prose.count(mark) for mark in punctuation)
+            dialogue_sentences = sum(dialogue.count(mark) for mark in punctuation)
+            p_sentence = "sentence" if prose_sentences == 1 else "sentences"
+            d_sentence = "sentence" if dialogue_sentences == 1 else "sentences"
+            if prose:
+                yield prose, f"Write {prose_sentences} {p_sentence} of description and action"
+            if dialogue:
+                yield dialogue, f"Write {dialogue_sentences} {d_sentence} of dialogue"
+
+def random_paragraph(rnd: random.Random) -> str:
+    return "".join(rnd.choice(PIECES) + rnd.choice(["", " "]) for _ in range(rnd.randint(0, 40)))
+
+def novel(rnd: random.Random, chapters: int = 5, paragraphs: int = 200) -> str:
+    "A book of prose and quoted dialogue, separated into chapters by *** markers."
+    words = "the house was quiet when she came back from the river and nobody looked up".split()
+
+    def sentence():
+        return " ".join(rnd.choice(words) for _ in range(rnd.randint(3, 12))).capitalize() + rnd.choice(".?!")
+
+    text = []
+    for _ in range(chapters):
+        for _ in range(paragraphs):
+            parts = []
+            for _ in range(rnd.randint(1, 5)):
+                if rnd.random() < 0.35:
+                    parts.append(f'"{sentence()}" {sentence()}')
+                else:
+                    parts.append(sentence())
+            text.append(" ".join(parts))
+        text.append("***")
+    return "\n".join(text)
+
+
+@pytest.mark.parametrize("paragraph, expected", [
+    ("", ("", "")),
+    ("No ending", ("", "")),
+    ("One. Two? Three!", ("One. Two? Three!", "")),
+    ('"Hello." She left.', ("", '"Hello."She left.')),
+    ('"Hello," she said. "Goodbye."', ('Goodbye."', '"Hello," she said. "')),
+    ('Wait... "Why?" he asked.', ('Wait... "', 'Why?"he asked.')),
+    ('He said "stop." Then "go." Done.', ('Then "go."Done.', 'He said "stop."')),
+    ('She nodded. "Fine."', ('She nodded. "', 'Fine."')),
+    ("Trailing space. ", ("", "")),
+])
+def test_extract_dialogue_golden(paragraph, expected):
+    # A mark only ends a sentence before a quote or at the end of the paragraph
+    assert extract_dialogue(paragraph) == expected
+    assert reference_extract_dialogue(paragraph) == expected
+
+def test_extract_dialogue_matches_reference():
+    rnd = random.Random(5)
+    for _ in range(20000):
+        paragraph = random_paragraph(rnd)
+        assert extract_dialogue(paragraph) == reference_extract_dialogue(paragraph), paragraph
+
+def test_dialogue_prose_matches_reference():
+    rnd = random.Random(7)
+    book = novel(rnd)
+    book += "\n" + "\n".join(random_paragraph(rnd) for _ in range(2000))
+    assert list(dialogue_prose(book)) == list(reference_dialogue_prose(book))
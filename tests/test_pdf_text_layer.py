@@ -0,0 +1,110 @@
+import random
+
+import pytest
+
+from ebook_conversion import pdf_conversion
+
+WORDS = "the quick brown fox jumps over lazy dog said she quietly and then walked away".split()
+METADATA = {"title": "Zzyzx Book", "author": "Qqv Author"}
+
+
+def escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def write_pdf(file_path: str, pages: list):
+    """
+    Writes a PDF with a Helvetica text layer. Each page is a list of
+    (x, y, font size, text) drawn in the order given.
+    """
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+    ]
+    page_ids = []
+    for page in pages:
+        content = "".join(
+            f"BT /F1 {size} Tf {x} {y} Td ({escape(text)}) Tj ET\n" for x, y, size, text in page
+        ).encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(content) + content + b"endstream")
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects)
+        )
+        page_ids.append(len(objects))
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids).encode()
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n" % number + obj + b"\nendobj\n"
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    data += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    data += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(file_path, "wb") as f:
+        f.write(data)
+
+def body(rnd: random.Random, top: int = 740) -> list:
+    "Paragraphs of random words from the top of the page down."
+    lines = []
+    y = top
+    while y > 80:
+        for _ in range(rnd.randint(2, 5)):
+            lines.append((72, y, 11, " ".join(rnd.choice(WORDS) for _ in range(12)).capitalize()))
+            y -= 14
+        lines.append((72, y, 11, "And so it ended."))
+        y -= 28
+    return lines
+
+def layouts(rnd: random.Random) -> list:
+    "Pages whose content order differs from their reading order in various ways."
+    pages = []
+    for number in range(1, 4):
+        # Page number drawn before the body
+        pages.append([(300, 40, 10, str(number))] + body(rnd))
+    # Page number and running head drawn after the body
+    pages.append(body(rnd, 700) + [(300, 40, 10, "4"), (250, 760, 9, "ZZYZX BOOK")])
+    # Centred chapter heading drawn last
+    pages.append(body(rnd, 640) + [(260, 700, 16, "Chapter 5")])
+    # Two columns, right column first
+    right = [(x + 260, y, size, text[:30]) for x, y, size, text in body(rnd)]
+    left = [(x, y, size, text[:30]) for x, y, size, text in body(rnd)]
+    pages.append(right + left)
+    # Lines drawn bottom to top, and a line made only of spaces
+    pages.append(list(reversed(body(rnd))) + [(72, 60, 11, "     ")])
+    # Words of one line drawn out of order, and a dangling character
+    pages.append([(200, 700, 11, "world"), (72, 700, 11, "hello"), (500, 400, 11, "x")] + body(rnd, 650))
+    return pages
+
+
+@pytest.fixture
+def pdf_path(tmp_path):
+    file_path = str(tmp_path / "book.pdf")
+    write_pdf(file_path, layouts(random.Random(1)))
+    return file_path
+
+
+def test_text_layer_pages_match_layout_analysis(pdf_path, monkeypatch):
+    monkeypatch.setattr(pdf_conversion, "PDF_FAST_TEXT_LAYER", False)
+    expected = pdf_conversion.extract_pages(pdf_path)
+    monkeypatch.setattr(pdf_conversion, "PDF_FAST_TEXT_LAYER", True)
+    assert pdf_conversion.extract_pages(pdf_path) == expected
+
+def test_footer_first_pages_have_no_chapter_markers(pdf_path, monkeypatch):
+    monkeypatch.setattr(pdf_conversion, "PDF_WORKERS", 0)
+    monkeypatch.setattr(pdf_conversion, "PDF_FAST_TEXT_LAYER", False)
+    expected = pdf_conversion.read_pdf(pdf_path, METADATA)
+    monkeypatch.setattr(pdf_conversion, "PDF_FAST_TEXT_LAYER", True)
+    text = pdf_conversion.read_pdf(pdf_path, METADATA)
+    assert text == expected
+    # Only the real chapter heading becomes a marker, not the page numbers
+    assert text.count(pdf_conversion.CHAPTER_MARKER.strip()) == 1
+
+def test_every_page_takes_the_text_layer_path(pdf_path):
+    with open(pdf_path, "rb") as f:
+        document = pdf_conversion.PDFDocument(pdf_conversion.PDFParser(f))
+        pages = list(pdf_conversion.PDFPage.create_pages(document))
+        assert all(pdf_conversion.has_text_layer(page) for page in pages)